@@ -1,4 +1,4 @@
-#!/usr/bin/python3
+#!/usr/bin/python3 -IS
 # contextual: providing context for shell command invocations
 # Copyright 2008-2015  Samuele Pedroni
 #
@@ -22,80 +22,77 @@ from __future__ import print_function
 import os
 import sys
 
-import landmark
-
+if __name__ == "__main__":
+    # isolated mode (-I) does not put the script directory on sys.path
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
 
-def infer_contexts(landmarks, locations, tracef):
-    context_pairs = []
-    unmatched_landmarks = landmarks[:]
-    for kind, location in locations:
-        tracef("start-dir[{}]: {}", kind, location)
-        location_segs = landmark.segs(location)
-        # use a rule only once
-        unmatched_landmarks2 = []
-        for lmark in unmatched_landmarks:
-            matched, context = lmark.match(location, location_segs)
-            if matched:
-                if context:
-                    tracef(" ~~ {} => {}", lmark.src, matched)
-                    context_pairs.append((matched, context))
-                else:
-                    # void context
-                    tracef(" ~~ {} => void_context", lmark.src)
-                    context_pairs.append((None, None))
-            else:
-                unmatched_landmarks2.append(lmark)
-                tracef(" ~~ {} => no", lmark.src)
-        unmatched_landmarks = unmatched_landmarks2
-    return context_pairs
+import ctxcache  # noqa
+from ctxresolve import cache_command, hook_command, Resolver, settings_from  # noqa
 
 
-def main(args):
+def main(args, environ=os.environ, cwd=None):
     args = list(args)
-    landmarks = landmark.parse(open(args[0]))
     runcmd = args[1]
-    trace = False
+    shortcut = None
+    if runcmd.startswith("@") and len(args) >= 3:
+        # @shortcut cmd ...
+        shortcut = runcmd[1:]
+        del args[1]
+        runcmd = args[1]
+    if runcmd == ":cache":
+        cache_command(args[0], args[2:])
+    elif runcmd == ":hook":
+        hook_command(args[0], args[2:], environ)
+        del args[2:]
+    flags = set()
+    while len(args) >= 3 and args[2] in (":trace", ":profile"):
+        flags.add(args.pop(2))
+    trace = ":trace" in flags
+    profile = ":profile" in flags
     tracef = lambda *a: None  # noqa
-    if len(args) >= 3 and args[2] == ":trace":
-        args.pop(2)
-        trace = True
+    if trace:
 
         def tracef(fmt, *a):
             print(fmt.format(*a), file=sys.stderr)
 
+    if cwd is None:
+        cwd = os.getcwd()
     locations = []
     if "/" in runcmd:
-        locations.append(("abscmd", os.path.dirname(os.path.abspath(runcmd))))
-    PWD = os.getenv("PWD")
+        abscmd = os.path.normpath(os.path.join(cwd, runcmd))
+        locations.append(("abscmd", os.path.dirname(abscmd)))
+    PWD = environ.get("PWD")
     if PWD:
         locations.append(("PWD", PWD))
-    locations.append(("getcwd", os.getcwd()))
+    locations.append(("getcwd", cwd))
 
-    context_pairs = infer_contexts(landmarks, locations, tracef)
+    resolver = Resolver(args[0], settings_from(environ), tracef)
+    if shortcut is not None:
+        total_context = resolver.shortcut(shortcut)
+        # for the error message
+        locations = "@" + shortcut
+    elif profile:
+        import json
 
-    if not context_pairs:
+        total_context, report = resolver.profile(locations, trace)
+        print(json.dumps(report, sort_keys=True), file=sys.stderr)
+    else:
+        total_context = resolver.context(locations, trace)
+
+    if total_context is None:
         print(
             "contextual: failed to infer context: {}".format(locations), file=sys.stderr
         )
         print("exit 1", file=sys.stdout)
         sys.exit(1)
 
-    contexts = []
-    # reverse so that early rules context effects have precedence
-    for matched, context in reversed(context_pairs):
-        if context is None:
-            continue
-        try:
-            contexts.append(context.format(*matched, ctx_dir=matched[0]))
-        except (IndexError, KeyError):
-            print(
-                "contextual: {!r} has unbound/unknown placeholder".format(context),
-                file=sys.stderr,
-            )
-    total_context = ";".join(contexts)
+    if shortcut is None and not (trace or profile) and locations[0][0] != "abscmd":
+        # for contextual warm
+        ctxcache.record_history(args[0], locations)
 
-    if trace:
-        print("CONTEXT => {}".format(total_context), file=sys.stderr)
+    if trace or profile:
+        if trace:
+            print("CONTEXT => {}".format(total_context), file=sys.stderr)
         print("exit 0", file=sys.stdout)
         sys.exit(0)
 
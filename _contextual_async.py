@@ -0,0 +1,114 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Resolve contexts from asyncio code without blocking the event loop.
+
+Landmark probes run in threads, e.g.:
+
+  prober = AsyncProber(limit=8)
+  pairs = await infer_contexts(index, [("dir", folder)], tracef, prober)
+"""
+import asyncio
+import os
+
+import ctxresolve
+import landmark
+
+
+class AsyncProber(object):
+    """Tests landmarks of rules in directories in threads, at most limit
+    at a time. Resolutions sharing a prober share the tests, also while
+    in flight, and the file system probes made, until invalidate().
+    A prober is meant to be used from one event loop."""
+
+    def __init__(self, limit=8, executor=None):
+        self.limit = limit
+        # None for the default executor of the loop
+        self.executor = executor
+        self.fs = landmark.FSCache()
+        self._semaphore = None
+        # (landmark, directory) => task testing it
+        self._tests = {}
+
+    def invalidate(self):
+        """Forget the tests and file system probes made so far."""
+        self.fs = landmark.FSCache()
+        self._tests = {}
+
+    async def run(self, fn, *args):
+        """=> fn(*args) run in a thread, within the concurrency limit."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    def test(self, lmark, p):
+        """=> awaitable of lmark landmarks tested for directory p."""
+        key = (lmark, p)
+        task = self._tests.get(key)
+        if task is None:
+            self.fs.steps["dirs"] += 1
+            task = asyncio.ensure_future(self.run(lmark._test_landmarks, p, self.fs))
+            self._tests[key] = task
+        # a resolution being cancelled doesn't cancel the test for others
+        return asyncio.shield(task)
+
+
+async def _match(lmark, p_segs, prober):
+    # as Landmark.match
+    levels = lmark.levels(p_segs)
+    if levels is None:
+        return None, None
+    start, i = levels
+    while i >= start:
+        lmark_p = os.path.join("/", "/".join(p_segs[0:i]))
+        matched = await prober.test(lmark, lmark_p)
+        if matched:
+            return matched, lmark.context
+        i -= 1
+    return None, None
+
+
+async def infer_contexts(landmarks, locations, tracef, prober=None):
+    """=> the context pairs ctxresolve.infer_contexts gives, probing
+    through prober, with the rules tested concurrently."""
+    if isinstance(landmarks, landmark.LandmarkIndex):
+        index = landmarks
+    else:
+        index = landmark.LandmarkIndex(landmarks)
+    if prober is None:
+        prober = AsyncProber()
+    context_pairs = []
+    # use a rule only once
+    matched_rules = set()
+    for kind, location in locations:
+        tracef("start-dir[{}]: {}", kind, location)
+        location_segs = landmark.segs(location)
+        # can load included files
+        candidates = await prober.run(index.candidates, location_segs, prober.fs)
+        candidates = [(i, lmark) for i, lmark in candidates if i not in matched_rules]
+        results = await asyncio.gather(
+            *[_match(lmark, location_segs, prober) for i, lmark in candidates]
+        )
+        for (i, lmark), (matched, context) in zip(candidates, results):
+            if matched:
+                matched_rules.add(i)
+            ctxresolve._add_context(context_pairs, lmark, matched, context, tracef)
+    return context_pairs
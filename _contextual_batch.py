@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Resolve the contexts of many start directories at once.
+
+Reads directories, one per line, from a file or stdin and prints one
+result per directory, as JSON or TSV, as soon as it is resolved, e.g.:
+
+  find ~/monorepo -name setup.py -printf '%h\\n' | contextual batch ~/.contextual
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import ctxcache
+import ctxresolve
+import landmark
+
+
+def resolve_dir(index, d, fs):
+    """=> (exit code, context or None) as _contextual.py run from d."""
+    if not os.path.isdir(d):
+        print("contextual: not a directory: {}".format(d), file=sys.stderr)
+        return 1, None
+    # as after cd d: PWD is d, getcwd the physical path
+    locations = [("PWD", d), ("getcwd", os.path.realpath(d))]
+    context_pairs = ctxresolve.infer_contexts(
+        index, locations, ctxresolve._trace_nothing, fs=fs
+    )
+    if not context_pairs:
+        print(
+            "contextual: failed to infer context: {}".format(locations), file=sys.stderr
+        )
+        return 1, None
+    return 0, ctxresolve.evaluate_contexts(context_pairs, fs)
+
+
+def format_result(d, code, context, fmt):
+    if fmt == "tsv":
+        return "{}\t{}\t{}".format(d, code, context if context is not None else "")
+    return json.dumps({"dir": d, "exit": code, "context": context}, sort_keys=True)
+
+
+# per worker process state, see _init_worker
+_index = None
+_fs = None
+
+
+def _init_worker(index):
+    global _index, _fs
+    _index = index
+    # probes are shared across the inputs of a worker
+    _fs = landmark.FSCache()
+
+
+def _resolve_in_worker(d):
+    return (d,) + resolve_dir(_index, d, _fs)
+
+
+def resolve_batch(index, dirs, jobs=1):
+    """=> iterator of (dir, exit code, context) in completion order."""
+    if jobs <= 1:
+        _init_worker(index)
+        return (_resolve_in_worker(d) for d in dirs)
+    pool = multiprocessing.Pool(jobs, _init_worker, (index,))
+    return _pool_results(pool, dirs)
+
+
+def _pool_results(pool, dirs):
+    try:
+        for res in pool.imap_unordered(_resolve_in_worker, dirs, chunksize=16):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_dirs(f):
+    for line in f:
+        line = line.rstrip("\n")
+        if line:
+            yield os.path.abspath(line)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="contextual batch", description=__doc__.splitlines()[1]
+    )
+    parser.add_argument("conf")
+    parser.add_argument("dirs", nargs="?", help="file of directories (default stdin)")
+    parser.add_argument("--format", choices=["json", "tsv"], default="json")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="worker processes to use"
+    )
+    opts = parser.parse_intermixed_args(args)
+
+    # parse the config once, workers share it
+    index = ctxcache.load_index(opts.conf)
+    f = open(opts.dirs) if opts.dirs else sys.stdin
+    failed = False
+    try:
+        for d, code, context in resolve_batch(index, read_dirs(f), opts.jobs):
+            failed |= code != 0
+            print(format_result(d, code, context, opts.format))
+            sys.stdout.flush()
+    finally:
+        if opts.dirs:
+            f.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
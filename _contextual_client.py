@@ -0,0 +1,79 @@
+#!/usr/bin/python3 -IS
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tiny client asking the resolver daemon, falls back to _contextual.py.
+
+Requests are the NUL separated PWD, cwd and _contextual.py arguments,
+replies the NUL separated exit code, stdout and stderr output.
+"""
+import os
+import socket
+import sys
+
+
+def socket_path():
+    """Path of the resolver daemon socket."""
+    sock_path = os.getenv("CONTEXTUAL_SOCKET")
+    if sock_path:
+        return sock_path
+    run_dir = os.getenv("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(run_dir, "contextual-{}.sock".format(os.getuid()))
+
+
+def request(sock_path, args, PWD, cwd):
+    """=> (exit code, out, err) of resolving args by the daemon."""
+    req = "\0".join([PWD or "", cwd] + list(args))
+    # the reply is evaluated by the shell, only trust our own daemon
+    if os.stat(sock_path).st_uid != os.getuid():
+        raise PermissionError("{} is not owned by us".format(sock_path))
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sock_path)
+        s.sendall(req.encode("utf-8", "surrogateescape"))
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+    reply = b"".join(chunks).decode("utf-8", "surrogateescape")
+    code, out, err = reply.split("\0", 2)
+    return int(code), out, err
+
+
+def main(args):
+    try:
+        code, out, err = request(socket_path(), args, os.getenv("PWD"), os.getcwd())
+    except (OSError, ValueError):
+        # daemon not running or gone, resolve directly
+        script = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "_contextual.py"
+        )
+        os.execv(sys.executable, [sys.executable, "-IS", script] + list(args))
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Long-lived resolver answering _contextual_client.py over a Unix socket.
+
+Parsed rules and resolved contexts caches stay loaded between requests.
+"""
+from __future__ import print_function
+
+import contextlib
+import io
+import os
+import signal
+import socketserver
+import sys
+import traceback
+
+import _contextual
+from _contextual_client import socket_path
+
+
+def resolve_request(req):
+    """=> (exit code, out, err) as running _contextual.py for request."""
+    PWD, cwd, *args = req.split("\0")
+    if args:
+        args[0] = os.path.join(cwd, args[0])
+    out = io.StringIO()
+    err = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            # settings like CONTEXTUAL_THREADS come from the daemon
+            environ = dict(os.environ, PWD=PWD)
+            _contextual.main(args, environ=environ, cwd=cwd)
+        except SystemExit as e:
+            code = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            code = 1
+    return code, out.getvalue(), err.getvalue()
+
+
+class ResolveHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        req = self.rfile.read().decode("utf-8", "surrogateescape")
+        code, out, err = resolve_request(req)
+        reply = "\0".join([str(code), out, err])
+        self.wfile.write(reply.encode("utf-8", "surrogateescape"))
+
+
+class ResolverServer(socketserver.UnixStreamServer):
+    """Serve requests one at a time, resolution redirects sys.stdout/err."""
+
+    def __init__(self, sock_path):
+        if os.path.exists(sock_path):
+            # stale socket of a previous run
+            os.unlink(sock_path)
+        socketserver.UnixStreamServer.__init__(self, sock_path, ResolveHandler)
+        os.chmod(sock_path, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def main(args):
+    sock_path = args[0] if args else socket_path()
+    server = ResolverServer(sock_path)
+    # clean up the socket on termination as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("contextual: resolver listening on {}".format(sock_path), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Rank the rules of a config by estimated cost and flag suspicious ones.
+
+Estimates statically, in the worst case, how many directories a rule
+walks and how many file system probes its conditions make there, and
+reports rules that are too expensive, can never match or are shadowed
+by earlier ones, e.g.:
+
+  contextual lint ~/.contextual
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shlex
+import sys
+
+import landmark
+
+# assumed entries per directory, a wildcard can match all of them
+DEFAULT_FANOUT = 20
+# assumed depth of start directories, bounds the walks of /** rules
+DEFAULT_DEPTH = 10
+# estimated probes per resolution above which rules are flagged
+DEFAULT_MAX_COST = 1000
+# custom checks run arbitrary code, which also makes contexts uncacheable
+CUSTOM_CHECK_COST = 10
+
+ROW = "{:>8} {:>5} {:>7} {:>9}  {}"
+
+
+class RuleCost(object):
+    """Worst case estimate for a rule: directories walked, probes made
+    testing each of them, most candidates a condition yields and times
+    the last condition is evaluated backtracking."""
+
+    def __init__(self, lmark, walk, probes, fanout, backtrack):
+        self.lmark = lmark
+        self.walk = walk
+        self.probes = probes
+        self.fanout = fanout
+        self.backtrack = backtrack
+
+    @property
+    def cost(self):
+        return self.walk * self.probes
+
+
+def _conds(lmark):
+    if isinstance(lmark.where, landmark.LandmarkClause):
+        return lmark.where.conds
+    return []
+
+
+def cond_estimate(cond, fanout):
+    """=> (probes, candidates) of one evaluation of cond."""
+    check_cost = 1 if cond.check in landmark.FS_CHECKS else CUSTOM_CHECK_COST
+    if cond.single:
+        return check_cost, 1
+    # placeholder values are taken literally
+    pattern = "".join(part for part in cond.parts if type(part) is str)
+    wildcards = sum(landmark._has_magic(seg) for seg in pattern.split("/"))
+    # a listing for each directory reached before each wildcard segment
+    listings = sum(fanout ** k for k in range(wildcards))
+    candidates = fanout ** wildcards
+    return listings + candidates * check_cost, candidates
+
+
+def walk_depth(lmark, depth):
+    """=> directories lmark tests for a start directory depth segments deep."""
+    if lmark.wildcard_descendant != "rec":
+        return 1
+    return max(1, depth - len(lmark.prefix_segs) + 1)
+
+
+def rule_cost(lmark, depth=DEFAULT_DEPTH, fanout=DEFAULT_FANOUT):
+    """=> RuleCost of lmark."""
+    probes = 0
+    widest = 1
+    # LandmarkClause.find_matches evaluates a condition once per
+    # combination of candidates of the conditions before it
+    evals = 1
+    backtrack = 1
+    for cond in _conds(lmark):
+        cond_probes, candidates = cond_estimate(cond, fanout)
+        probes += evals * cond_probes
+        widest = max(widest, candidates)
+        backtrack = evals
+        evals *= candidates
+    return RuleCost(lmark, walk_depth(lmark, depth), probes, widest, backtrack)
+
+
+def never_matches(lmark):
+    """=> why lmark can never match, None if it can."""
+    for seg in lmark.prefix_segs:
+        # only a final /* or /** is a wildcard, prefix segments are
+        # compared literally and [ or ? can be part of directory names
+        if "*" in seg:
+            return "prefix segment {!r} is not a wildcard".format(seg)
+    not_dirs = (os.path.isfile, landmark.check_is_non_empty)
+    checks = {}
+    for cond in _conds(lmark):
+        if cond.relative.endswith("/") and cond.check in not_dirs:
+            return "{!r} matches only directories, never files".format(cond.relative)
+        if cond.literal is not None:
+            checks.setdefault(cond.literal.rstrip("/"), set()).add(cond.check)
+    for relative, rel_checks in sorted(checks.items()):
+        if os.path.isdir in rel_checks and rel_checks.intersection(not_dirs):
+            return "{!r} is checked to be both a directory and a file".format(relative)
+    return None
+
+
+def covers(lmark, other):
+    """Whether lmark matches whenever the later rule other does."""
+    if lmark.deadline is not None:
+        # can be abandoned
+        return False
+    n_prefix_segs = len(lmark.prefix_segs)
+    if other.prefix_segs[:n_prefix_segs] != lmark.prefix_segs:
+        return False
+    deeper = len(other.prefix_segs) - n_prefix_segs
+    levels = (deeper, other.wildcard_descendant)
+    if not _conds(lmark):
+        # matches at every start dir under its prefix (below it for /*)
+        if lmark.wildcard_descendant is None:
+            return True
+        if lmark.wildcard_descendant == "one":
+            return deeper >= 1 or levels == (0, "one")
+    if lmark.wildcard_descendant is None and levels != (0, None):
+        return False
+    if lmark.wildcard_descendant == "one" and levels not in ((1, None), (0, "one")):
+        return False
+    # other tests the same conditions, and more, where it matched
+    conds = [(cond.check, cond.relative) for cond in _conds(lmark)]
+    other_conds = [(cond.check, cond.relative) for cond in _conds(other)]
+    return conds == other_conds[: len(conds)]
+
+
+def assigned(context):
+    """=> names of the variables context assigns, None if it does
+    anything else."""
+    names = set()
+    for statement in context.split(";"):
+        try:
+            words = shlex.split(statement)
+        except ValueError:
+            return None
+        if words[:1] == ["export"]:
+            del words[0]
+        for word in words:
+            name, eq, value = word.partition("=")
+            if not eq or not name.isidentifier():
+                return None
+            names.add(name)
+    return names
+
+
+def overrides(context, other):
+    """Whether context, of an earlier rule, makes other have no effect."""
+    if context == other:
+        return True
+    names, other_names = assigned(context), assigned(other)
+    # earlier rules context effects have precedence
+    return bool(names and other_names) and other_names <= names
+
+
+def lint(
+    landmarks,
+    depth=DEFAULT_DEPTH,
+    fanout=DEFAULT_FANOUT,
+    within=(),
+    load=None,
+    including=(),
+):
+    """=> ([RuleCost], [(rule source, problem)]) for landmarks and the
+    rules of the files they include, used only under prefix segments
+    within. including are the real paths of the files including
+    landmarks, as for LandmarkIndex.candidates."""
+    if load is None:
+        load = landmark.load_include
+    costs = []
+    issues = []
+    for j, lmark in enumerate(landmarks):
+        if lmark.prefix_segs[: len(within)] != list(within):
+            # as LandmarkIndex.candidates
+            issues.append((lmark.src, "outside the prefix of its include, never used"))
+            continue
+        if isinstance(lmark, landmark.Include):
+            inc_path = os.path.realpath(lmark.path)
+            if inc_path in including:
+                issues.append((lmark.src, "include cycle"))
+                continue
+            try:
+                included = load(lmark.path).landmarks
+            except OSError as e:
+                issues.append((lmark.src, str(e)))
+                continue
+            inc_costs, inc_issues = lint(
+                included,
+                depth,
+                fanout,
+                lmark.prefix_segs,
+                load,
+                including + (inc_path,),
+            )
+            costs.extend(inc_costs)
+            issues.extend(inc_issues)
+            continue
+        costs.append(rule_cost(lmark, depth, fanout))
+        reason = never_matches(lmark)
+        if reason is not None:
+            issues.append((lmark.src, "never matches: {}".format(reason)))
+        if not lmark.context:
+            continue
+        for earlier in landmarks[:j]:
+            if isinstance(earlier, landmark.Include):
+                continue
+            if covers(earlier, lmark) and overrides(earlier.context, lmark.context):
+                problem = "shadowed by earlier rule: {}".format(earlier.src)
+                issues.append((lmark.src, problem))
+                break
+    return costs, issues
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="contextual lint", description=__doc__.splitlines()[1]
+    )
+    parser.add_argument("conf")
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=DEFAULT_DEPTH,
+        help="assumed start directory depth (default %(default)s)",
+    )
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        default=DEFAULT_FANOUT,
+        help="assumed entries per directory (default %(default)s)",
+    )
+    parser.add_argument(
+        "--max-cost",
+        type=int,
+        default=DEFAULT_MAX_COST,
+        help="flag rules estimated to probe more (default %(default)s)",
+    )
+    opts = parser.parse_args(args)
+
+    cfg_path = os.path.abspath(opts.conf)
+    with open(cfg_path) as f:
+        # reports rules that don't parse
+        landmarks = landmark.parse(f, os.path.dirname(cfg_path))
+    costs, issues = lint(
+        landmarks,
+        opts.depth,
+        opts.fanout,
+        including=(os.path.realpath(cfg_path),),
+    )
+    costs.sort(key=lambda cost: -cost.cost)
+    print(ROW.format("cost", "walk", "fan-out", "backtrack", "rule"))
+    for cost in costs:
+        lmark = cost.lmark
+        print(ROW.format(cost.cost, cost.walk, cost.fanout, cost.backtrack, lmark.src))
+        if cost.cost > opts.max_cost:
+            problem = "expensive, up to {} probes: {} in each of {} directories"
+            problem = problem.format(cost.cost, cost.probes, cost.walk)
+            issues.append((lmark.src, problem))
+    for src, problem in issues:
+        print("contextual: [rule: {}] {}".format(src, problem))
+    sys.exit(1 if issues else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
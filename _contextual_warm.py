@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Precompute the cached contexts of recently used directories.
+
+Resolves at low priority the start directories in the history of the
+config (or directories read one per line from a file or stdin) so that
+interactive invocations there hit warm caches, e.g. from ~/.bashrc:
+
+  (contextual warm ~/.contextual &)
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import ctxcache
+import ctxresolve
+from _contextual_batch import read_dirs
+
+
+def dir_locations(d):
+    """=> start directories locations of _contextual.py run from d."""
+    # as after cd d: PWD is d, getcwd the physical path
+    return [("PWD", d), ("getcwd", os.path.realpath(d))]
+
+
+def warm(resolver, history):
+    """Resolve the locations in history with resolver, storing the
+    contexts missing from the caches.
+
+    => number of locations warmed."""
+    warmed = 0
+    for locations in history:
+        if not all(os.path.isdir(location) for kind, location in locations):
+            # gone, left for the history to drop eventually
+            continue
+        # a cache hit just refreshes the entry for the contextual script
+        resolver.context(locations)
+        warmed += 1
+    return warmed
+
+
+def main(args, environ=os.environ):
+    parser = argparse.ArgumentParser(
+        prog="contextual warm", description=__doc__.splitlines()[1]
+    )
+    parser.add_argument("conf")
+    parser.add_argument(
+        "dirs", nargs="?", help="file of directories, - for stdin (default history)"
+    )
+    parser.add_argument(
+        "--nice", type=int, default=10, help="niceness increment (default 10)"
+    )
+    opts = parser.parse_intermixed_args(args)
+
+    if opts.nice:
+        os.nice(opts.nice)
+    if opts.dirs is None:
+        history = ctxcache.load_history(opts.conf)
+    elif opts.dirs == "-":
+        history = [dir_locations(d) for d in read_dirs(sys.stdin)]
+    else:
+        with open(opts.dirs) as f:
+            history = [dir_locations(d) for d in read_dirs(f)]
+    resolver = ctxresolve.Resolver(opts.conf, ctxresolve.settings_from(environ))
+    warm(resolver, history)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
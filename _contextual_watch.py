@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Keep a live directory to context map for a tree using Linux inotify.
+"""
+from __future__ import print_function
+
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+
+import ctxcache
+import ctxresolve
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Minimal ctypes binding to Linux inotify."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """=> watch descriptor for directory path, None if it is missing
+        or not a directory; OSError for other failures, e.g. ENOSPC
+        when out of watches."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """=> [(wd, mask, name)] available within timeout (in seconds)."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos : pos + name_len].rstrip(b"\0")  # noqa
+            pos += name_len
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _under(p, d):
+    return p == d or p.startswith(d.rstrip("/") + "/")
+
+
+class ContextWatcher(object):
+    """Maintain contexts of all directories under root as the tree changes."""
+
+    def __init__(self, cfg_path, root, inotify=None):
+        self.cfg_path = os.path.abspath(cfg_path)
+        self.root = os.path.abspath(root)
+        self.inotify = inotify or Inotify()
+        self.wds = {}
+        self.wd_dirs = {}
+        self.contexts = {}
+        # directory => probed paths, probed path => dependent directories
+        self.deps = {}
+        self.dependents = {}
+
+    def _watch(self, d):
+        """Watch d or its nearest existing ancestor, => whether newly.
+
+        OSError if it cannot be watched while it exists.
+        """
+        while d not in self.wds:
+            wd = self.inotify.add_watch(d)
+            if wd is not None:
+                self.wds[d] = wd
+                self.wd_dirs[wd] = d
+                return True
+            parent = os.path.dirname(d)
+            if parent == d:
+                break
+            d = parent
+        return False
+
+    def _forget(self, d):
+        self.contexts.pop(d, None)
+        for p in self.deps.pop(d, ()):
+            dependents = self.dependents[p]
+            dependents.discard(d)
+            if not dependents:
+                del self.dependents[p]
+
+    def resolve_dir(self, d):
+        self._forget(d)
+        locations = [("getcwd", d)]
+        context, fs = ctxresolve.resolve_uncached(
+            self.index, locations, ctxresolve._trace_nothing
+        )
+        if not fs.complete:
+            # leave it to normal resolution
+            return
+        self.contexts[d] = context
+        probed = set()
+        to_watch = []
+        for kind, key, sig in fs.dependencies():
+            if kind == "access":
+                key = key[0]
+            probed.add(key)
+            self.dependents.setdefault(key, set()).add(d)
+            to_watch.append(key if kind == "listdir" else os.path.dirname(key))
+        self.deps[d] = probed
+        watched = False
+        try:
+            for p in to_watch:
+                watched |= self._watch(p)
+        except OSError:
+            # changes would go unnoticed, leave it to normal resolution
+            self._forget(d)
+            return
+        if watched:
+            # changes before the watches were in place would be missed
+            self.resolve_dir(d)
+
+    def add_tree(self, top):
+        for d, subdirs, files in os.walk(top):
+            try:
+                self._watch(d)
+            except OSError:
+                # new subdirectories are left to normal resolution
+                pass
+            self.resolve_dir(d)
+
+    def build(self):
+        """(Re)compute the whole map."""
+        self.index = ctxcache.load_index(self.cfg_path)
+        for d in list(self.deps):
+            self._forget(d)
+        self._watch(os.path.dirname(self.cfg_path))
+        self.add_tree(self.root)
+        self.save()
+
+    def save(self):
+        ctxcache.store_watch_map(self.cfg_path, self.root, self.contexts)
+
+    def affected(self, p, subtree=False):
+        """=> directories whose context depends on p (or entries under it)."""
+        affected = set(self.dependents.get(p, ()))
+        if subtree:
+            for probed, dependents in self.dependents.items():
+                if _under(probed, p):
+                    affected.update(dependents)
+        return affected
+
+    def handle_events(self, events):
+        """Update the map for events, => whether it changed."""
+        stale = set()
+        new_trees = set()
+        changed = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.build()
+                return True
+            d = self.wd_dirs.get(wd)
+            if d is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.wd_dirs[wd]
+                if self.wds.get(d) == wd:
+                    del self.wds[d]
+                continue
+            p = os.path.join(d, name) if name else d
+            if p == self.cfg_path:
+                self.build()
+                return True
+            # d listing changed, p itself or (for directories) entries under it
+            stale.update(self.affected(d))
+            stale.update(self.affected(p, not name or mask & IN_ISDIR))
+            if mask & IN_ISDIR and _under(p, self.root):
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    new_trees.add(p)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    for gone in [c for c in self.deps if _under(c, p)]:
+                        self._forget(gone)
+                        changed = True
+        for d in stale:
+            if d in self.contexts or d in self.deps:
+                if os.path.isdir(d):
+                    self.resolve_dir(d)
+                else:
+                    self._forget(d)
+                changed = True
+        for top in new_trees:
+            if os.path.isdir(top):
+                self.add_tree(top)
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def process_events(self, timeout=None):
+        return self.handle_events(self.inotify.read_events(timeout))
+
+    def run(self):
+        self.build()
+        while True:
+            self.process_events()
+
+
+def main(args):
+    if len(args) != 2:
+        print("usage: contextual watch conf root", file=sys.stderr)
+        sys.exit(2)
+    watcher = ContextWatcher(args[0], args[1])
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmark the landmark matching engine on synthetic trees and configs.
+
+Prints one JSON object per rules count with parse time, resolution
+latencies and file system call counts, e.g.:
+
+  bench_landmark.py --depth 5 --fanout 3 --rules 10 1000 100000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import ctxresolve
+import landmark
+
+
+def make_tree(root, depth, fanout, entries, landmark_every):
+    """Create a tree of directories d<i>, => list of the leaf directories.
+
+    Every directory gets entries files e<i> for globs to go through,
+    every landmark_every-th one also a .git directory and a virtualenv.
+    """
+    leaves = []
+    count = 0
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                p = os.path.join(parent, "d{}".format(i))
+                os.mkdir(p)
+                for j in range(entries):
+                    open(os.path.join(p, "e{}".format(j)), "w").close()
+                count += 1
+                if count % landmark_every == 0:
+                    os.mkdir(os.path.join(p, ".git"))
+                    os.makedirs(os.path.join(p, "venv", "bin"))
+                    with open(os.path.join(p, "venv", "bin", "activate"), "w") as f:
+                        f.write("#\n")
+                next_level.append(p)
+        level = next_level
+    leaves.extend(level)
+    return leaves
+
+
+def make_config(root, n_rules, fanout, seed=0):
+    """=> config lines mixing /*, /** and where rules under root."""
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n_rules):
+        kind = i % 4
+        top = "d{}".format(rnd.randrange(fanout))
+        if rnd.random() < 0.5:
+            # most rules of a big config are about unrelated trees
+            top = "other{}".format(i)
+        prefix = os.path.join(root, top)
+        if kind == 0:
+            lines.append(
+                "{}/* where -d .git := export A{}={{ctx_dir}}".format(prefix, i)
+            )
+        elif kind == 1:
+            lines.append(
+                "{}/** where -f */bin/activate := source {{1}} # {}".format(prefix, i)
+            )
+        elif kind == 2:
+            lines.append(
+                "{}/** where -e .mark{} -f e* := export C{}={{1}}".format(prefix, i, i)
+            )
+        else:
+            lines.append("{} := export D{}=1".format(prefix, i))
+    lines.append("/ :=")
+    return lines
+
+
+def bench(lines, start_dirs, repeat):
+    """=> measurements of parsing lines and resolving start_dirs."""
+    start = time.perf_counter()
+    landmarks = landmark.parse(lines)
+    parse_s = time.perf_counter() - start
+    start = time.perf_counter()
+    index = landmark.LandmarkIndex(landmarks)
+    index_s = time.perf_counter() - start
+    latencies = []
+    counts = dict.fromkeys(["stat", "lstat", "access", "scandir", "glob"], 0)
+    for r in range(repeat):
+        for d in start_dirs:
+            locations = [("PWD", d), ("getcwd", d)]
+            start = time.perf_counter()
+            context, fs = ctxresolve.resolve_uncached(
+                index, locations, ctxresolve._trace_nothing
+            )
+            latencies.append(time.perf_counter() - start)
+            for call, n in fs.counts.items():
+                counts[call] += n
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "rules": len(landmarks),
+        "parse_s": parse_s,
+        "index_s": index_s,
+        "resolutions": n,
+        "latency_s": {
+            "min": latencies[0],
+            "median": latencies[n // 2],
+            "p90": latencies[min(n - 1, n * 9 // 10)],
+            "max": latencies[-1],
+        },
+        "fs_calls_per_resolution": {call: c / n for call, c in counts.items()},
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--entries", type=int, default=5, help="files per dir")
+    parser.add_argument("--landmark-every", type=int, default=4)
+    parser.add_argument("--rules", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--starts", type=int, default=20, help="start dirs")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON lines here too")
+    opts = parser.parse_args(args)
+
+    tmp = tempfile.mkdtemp(prefix="contextual-bench-")
+    try:
+        root = os.path.realpath(tmp)
+        leaves = make_tree(
+            root, opts.depth, opts.fanout, opts.entries, opts.landmark_every
+        )
+        rnd = random.Random(opts.seed)
+        start_dirs = [rnd.choice(leaves) for i in range(opts.starts)]
+        params = {
+            "depth": opts.depth,
+            "fanout": opts.fanout,
+            "entries": opts.entries,
+            "landmark_every": opts.landmark_every,
+            "starts": opts.starts,
+            "repeat": opts.repeat,
+            "python": sys.version.split()[0],
+        }
+        out = open(opts.output, "a") if opts.output else None
+        for n_rules in opts.rules:
+            lines = make_config(root, n_rules, opts.fanout, opts.seed)
+            result = dict(params, **bench(lines, start_dirs, opts.repeat))
+            line = json.dumps(result, sort_keys=True)
+            print(line)
+            if out:
+                print(line, file=out)
+        if out:
+            out.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,770 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Persistent on-disk caches keyed by configuration file identity.
+"""
+from __future__ import print_function
+
+import fcntl
+import marshal
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+import landmark
+
+# bump when the pickled representation of landmarks changes
+RULES_CACHE_VERSION = 6
+# bump when the representation of resolved contexts entries changes
+CONTEXTS_CACHE_VERSION = 4
+# resolved contexts entries kept per config, a buckets x ways table of
+# fixed size slots, the oldest entry of a full bucket is dropped first
+CONTEXTS_BUCKETS = 256
+CONTEXTS_WAYS = 4
+CONTEXTS_SLOT = 4096
+MAX_CONTEXTS_ENTRIES = CONTEXTS_BUCKETS * CONTEXTS_WAYS
+# entries larger than a slot spill to a file of their own up to this size
+CONTEXTS_SPILL_MAX = 1 << 20
+# magic, version, buckets, ways, slot size
+_TABLE_HEADER = struct.Struct("<4sIIII")
+# sequence (odd while written), payload length and crc32, key hash, stamp
+_SLOT_HEADER = struct.Struct("<IIIIQ")
+CONTEXTS_TABLE_SIZE = _TABLE_HEADER.size + MAX_CONTEXTS_ENTRIES * CONTEXTS_SLOT
+# bump when the representation of the watcher directory map changes
+WATCH_MAP_VERSION = 2
+# bump when the representation of the slow rules record changes
+SLOW_RULES_VERSION = 1
+# bump when the representation of the shortcut table changes
+SHORTCUTS_VERSION = 2
+# bump when the representation of captured environment changes changes
+CAPTURES_VERSION = 1
+# captured contexts kept, oldest are dropped first
+MAX_CAPTURES = 64
+# bump when the representation of the directory history changes
+HISTORY_VERSION = 1
+# start directories remembered per config, least recently used are dropped
+MAX_HISTORY = 64
+
+
+def cache_dir():
+    """Directory holding contextual caches (under XDG_CACHE_HOME)."""
+    base = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "contextual")
+
+
+def config_identity(cfg_path):
+    """=> (absolute path, size, mtime in ns) of the config file."""
+    cfg_path = os.path.abspath(cfg_path)
+    st = os.stat(cfg_path)
+    return cfg_path, st.st_size, st.st_mtime_ns
+
+
+def cache_path(cfg_path, kind):
+    """Path of the kind cache file for the given config."""
+    cfg_path = os.path.abspath(cfg_path)
+    # entries also record the config path, a clash just forces rebuilds
+    key = zlib.crc32(os.fsencode(cfg_path))
+    name = "{}-{:08x}.{}".format(os.path.basename(cfg_path), key, kind)
+    return os.path.join(cache_dir(), name)
+
+
+def _pickle():
+    # only the rules cache needs pickle, hits of the others avoid importing it
+    import pickle
+
+    return pickle
+
+
+# loaded cache files, reused while unchanged by long-lived processes
+_loaded = {}
+
+
+def _load(cache_p, version, codec=marshal):
+    """=> fields stored after version in cache file, None if unusable."""
+    try:
+        st = os.stat(cache_p)
+        sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+        loaded = _loaded.get(cache_p)
+        if loaded is not None and loaded[0] == sig:
+            return loaded[1]
+        with open(cache_p, "rb") as f:
+            obj = codec.load(f)
+    except Exception:
+        # missing, truncated or from an incompatible version: just rebuild
+        return None
+    if type(obj) is not tuple or not obj or obj[0] != version:
+        return None
+    obj = obj[1:]
+    _loaded[cache_p] = (sig, obj)
+    return obj
+
+
+def _store(cache_p, version, fields, codec=marshal):
+    tmp_p = "{}.{}.tmp".format(cache_p, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_p), exist_ok=True)
+        with open(tmp_p, "wb") as f:
+            codec.dump((version,) + fields, f)
+        os.replace(tmp_p, cache_p)
+    except Exception:
+        # e.g. read-only cache dir or unpicklable custom check
+        try:
+            os.unlink(tmp_p)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _cached_rules(cfg_path, ident):
+    cached = _load(cache_path(cfg_path, "rules"), RULES_CACHE_VERSION, _pickle())
+    if cached is None:
+        return "missing", None
+    cached_ident, index = cached
+    if cached_ident != ident:
+        return "stale", None
+    return "fresh", index
+
+
+def load_index(cfg_path, rebuild=False):
+    """Indexed parsed landmarks of config, from the rules cache if valid."""
+    ident = config_identity(cfg_path)
+    if not rebuild:
+        state, index = _cached_rules(cfg_path, ident)
+        if index is not None:
+            # keep reporting the rules that did not parse
+            for line in index.warnings:
+                print(line, file=sys.stderr)
+            index.path = ident[0]
+            index.load_include = load_index
+            return index
+    warnings = []
+
+    def report(line):
+        print(line, file=sys.stderr)
+        warnings.append(line)
+
+    with open(cfg_path) as f:
+        cfg_dir = os.path.dirname(ident[0])
+        index = landmark.LandmarkIndex(landmark.parse(f, cfg_dir, report))
+    index.warnings = warnings
+    rules_p = cache_path(cfg_path, "rules")
+    _store(rules_p, RULES_CACHE_VERSION, (ident, index), _pickle())
+    index.path = ident[0]
+    # included files get their own rules cache
+    index.load_include = load_index
+    return index
+
+
+def load_landmarks(cfg_path, rebuild=False):
+    """Parsed landmarks of config, from the rules cache if still valid."""
+    return load_index(cfg_path, rebuild).landmarks
+
+
+def rules_cache_info(cfg_path):
+    """=> list of (label, value) describing the rules cache of config."""
+    ident = config_identity(cfg_path)
+    state, index = _cached_rules(cfg_path, ident)
+    info = [
+        ("config", "{} (size {}, mtime_ns {})".format(*ident)),
+        ("rules-cache", cache_path(cfg_path, "rules")),
+        ("state", state),
+    ]
+    if index is not None:
+        info.append(("rules", len(index.landmarks)))
+    return info
+
+
+def _contexts_path(cfg_path):
+    return cache_path(cfg_path, "contexts")
+
+
+# mapped contexts tables, reused while the file is not replaced
+_mapped = {}
+
+
+def _contexts_table(cfg_path):
+    """=> read-only mapping of the contexts table of config, None if
+    there is no usable one."""
+    table_p = _contexts_path(cfg_path)
+    try:
+        st = os.stat(table_p)
+    except OSError:
+        return None
+    mapped = _mapped.get(table_p)
+    if mapped is not None and mapped[0] == st.st_ino:
+        return mapped[1]
+    if st.st_size != CONTEXTS_TABLE_SIZE:
+        # being created or from an incompatible version
+        return None
+    try:
+        with open(table_p, "rb") as f:
+            table = mmap.mmap(f.fileno(), CONTEXTS_TABLE_SIZE, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if table[:_TABLE_HEADER.size] != _table_header():
+        table.close()
+        return None
+    _mapped[table_p] = (st.st_ino, table)
+    return table
+
+
+def _table_header():
+    return _TABLE_HEADER.pack(
+        b"ctxm", CONTEXTS_CACHE_VERSION, CONTEXTS_BUCKETS, CONTEXTS_WAYS, CONTEXTS_SLOT
+    )
+
+
+def _slot_offset(i):
+    return _TABLE_HEADER.size + i * CONTEXTS_SLOT
+
+
+def _bucket(key_hash):
+    first = key_hash % CONTEXTS_BUCKETS * CONTEXTS_WAYS
+    return range(first, first + CONTEXTS_WAYS)
+
+
+def _read_slot(table, i):
+    """=> (key hash, stamp, payload) of slot i, None if empty or being
+    written concurrently."""
+    off = _slot_offset(i)
+    seq, length, crc, key_hash, stamp = _SLOT_HEADER.unpack_from(table, off)
+    if seq & 1 or not length or length > CONTEXTS_SLOT - _SLOT_HEADER.size:
+        return None
+    start = off + _SLOT_HEADER.size
+    payload = table[start : start + length]
+    # a writer got in between or the stores are only partly visible
+    if _SLOT_HEADER.unpack_from(table, off)[0] != seq or zlib.crc32(payload) != crc:
+        return None
+    return key_hash, stamp, payload
+
+
+def _key_hash(key):
+    # not of marshal.dumps(key), that depends on strings being interned
+    return zlib.crc32(repr(key).encode("utf-8", "surrogateescape"))
+
+
+def _slot_entry(slot):
+    # => (key, ident, context, deps) stored in slot
+    try:
+        return marshal.loads(zlib.decompress(slot[2]))
+    except Exception:
+        return None
+
+
+def _slot_key(slot):
+    entry = _slot_entry(slot)
+    return entry and entry[0]
+
+
+def _spill_path(cfg_path, name):
+    return os.path.join(cache_path(cfg_path, "spill"), name)
+
+
+def _slot_spill(slot):
+    # => name of the file slot spilled its entry to, None if it did not
+    entry = _slot_entry(slot)
+    if entry is not None and len(entry) == 3:
+        return entry[2]
+    return None
+
+
+def _spilled_entry(cfg_path, key, name):
+    # => (status reason, (ident, context, deps)) of an entry spilled to name
+    if name is None:
+        return "too large", None
+    try:
+        with open(_spill_path(cfg_path, name), "rb") as f:
+            entry = marshal.loads(zlib.decompress(f.read()))
+    except Exception:
+        return "spilled entry gone", None
+    if entry[0] != key:
+        return "spilled entry gone", None
+    return None, entry[1:]
+
+
+def _table_entry(cfg_path, key):
+    """=> (status reason, (ident, context, deps)) of the entry for key."""
+    table = _contexts_table(cfg_path)
+    if table is None:
+        return "no entries", None
+    key_hash = _key_hash(key)
+    for i in _bucket(key_hash):
+        slot = _read_slot(table, i)
+        if slot is None or slot[0] != key_hash:
+            continue
+        entry = _slot_entry(slot)
+        if entry is not None and entry[0] == key:
+            if len(entry) == 3:
+                # (key, None, spill file name or None if too large)
+                return _spilled_entry(cfg_path, key, entry[2])
+            return None, entry[1:]
+    return "no entry", None
+
+
+def lookup_context(cfg_path, locations):
+    """Look up the resolved context for start directories locations.
+
+    => (status, detail, context) with status one of hit, miss or
+    invalidated; context is None for a failed resolution.
+    """
+    return lookup_context_deps(cfg_path, locations)[:3]
+
+
+def lookup_context_deps(cfg_path, locations):
+    """=> lookup_context(cfg_path, locations) results followed by the
+    probes recorded with a hit, None otherwise."""
+    ident = config_identity(cfg_path)
+    reason, entry = _table_entry(cfg_path, tuple(locations))
+    if reason:
+        return "miss", reason, None, None
+    entry_ident, context, deps = entry
+    if entry_ident != ident:
+        return "miss", "config changed", None, None
+    dep = landmark.changed_dependency(deps)
+    if dep is not None:
+        kind, key, sig = dep
+        return "invalidated", "{} {} changed".format(kind, key), None, None
+    return "hit", None, context, deps
+
+
+def _open_table_locked(table_p):
+    """=> writable mapping of the contexts table at table_p, with fd
+    holding its write lock; creates the table if needed."""
+    os.makedirs(os.path.dirname(table_p), exist_ok=True)
+    while True:
+        fd = os.open(table_p, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            st = os.fstat(fd)
+            if os.stat(table_p).st_ino != st.st_ino:
+                # replaced while waiting for the lock
+                os.close(fd)
+                continue
+            if st.st_size == CONTEXTS_TABLE_SIZE:
+                table = mmap.mmap(fd, CONTEXTS_TABLE_SIZE)
+                if table[: _TABLE_HEADER.size] == _table_header():
+                    return fd, table
+                table.close()
+            # never shrink or rewrite a table in place, readers may
+            # have it mapped, replace it by a fresh one instead
+            tmp_p = "{}.{}.tmp".format(table_p, os.getpid())
+            with open(tmp_p, "wb") as f:
+                f.write(_table_header())
+                f.truncate(CONTEXTS_TABLE_SIZE)
+            os.replace(tmp_p, table_p)
+            os.close(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+
+
+def _write_slot(table, i, key_hash, payload):
+    off = _slot_offset(i)
+    # odd while writing, readers skip the slot, also after a writer died
+    seq = _SLOT_HEADER.unpack_from(table, off)[0]
+    busy = ((seq + 1) | 1) % 2 ** 32
+    struct.pack_into("<I", table, off, busy)
+    start = off + _SLOT_HEADER.size
+    table[start : start + len(payload)] = payload
+    _SLOT_HEADER.pack_into(
+        table,
+        off,
+        busy,
+        len(payload),
+        zlib.crc32(payload),
+        key_hash,
+        time.time_ns(),
+    )
+    struct.pack_into("<I", table, off, (busy + 1) % 2 ** 32)
+
+
+def store_context(cfg_path, locations, context, fs):
+    """Store resolved context with the probes recorded by FSCache fs.
+
+    Entries go in a table file mapped by every process resolving with
+    the config: readers take no lock, writers serialize on a file lock.
+    Entries larger than a slot go to a spill file, the slot refers to it.
+    """
+    if not fs.complete:
+        return False
+    ident = config_identity(cfg_path)
+    key = tuple(locations)
+    key_hash = _key_hash(key)
+    payload = zlib.compress(marshal.dumps((key, ident, context, fs.dependencies())), 1)
+    try:
+        fd, table = _open_table_locked(_contexts_path(cfg_path))
+    except (OSError, ValueError):
+        # e.g. read-only cache dir
+        return False
+    try:
+        victim = None
+        for i in _bucket(key_hash):
+            slot = _read_slot(table, i)
+            if slot is None:
+                rank = 0
+            elif slot[0] == key_hash and _slot_key(slot) == key:
+                rank = -1
+            else:
+                # the least recently stored entry of the bucket goes first
+                rank = slot[1]
+            if victim is None or rank < victim[0]:
+                victim = (rank, i)
+        i = victim[1]
+        slot = _read_slot(table, i)
+        old_spill = slot and _slot_spill(slot)
+        spill = None
+        stored = True
+        if len(payload) > CONTEXTS_SLOT - _SLOT_HEADER.size:
+            if len(payload) <= CONTEXTS_SPILL_MAX:
+                spill = "{:08x}-{:08x}".format(key_hash, zlib.crc32(payload))
+                if not _write_spill(_spill_path(cfg_path, spill), payload):
+                    spill = None
+            stored = spill is not None
+            # too many probes to keep in the table, lookups report why
+            payload = zlib.compress(marshal.dumps((key, None, spill)), 1)
+        _write_slot(table, i, key_hash, payload)
+        if old_spill is not None and old_spill != spill:
+            try:
+                os.unlink(_spill_path(cfg_path, old_spill))
+            except OSError:
+                pass
+    finally:
+        table.close()
+        os.close(fd)
+    return stored
+
+
+def _write_spill(spill_p, payload):
+    tmp_p = "{}.{}.tmp".format(spill_p, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(spill_p), exist_ok=True)
+        with open(tmp_p, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_p, spill_p)
+    except OSError:
+        try:
+            os.unlink(tmp_p)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _shell_key(p):
+    # injective file name for path p, computed the same by the contextual script
+    return p.replace("%", "%25").replace("/", "%2F")
+
+
+def _shell_quote(s):
+    # shlex.quote, without importing shlex on the resolution path
+    return "'" + s.replace("'", "'\\''") + "'"
+
+
+def shell_entry_path(cfg_path, pwd):
+    """Path of the shell readable resolution of config for PWD pwd."""
+    cfg_key = _shell_key(os.path.abspath(cfg_path))
+    return os.path.join(cache_dir(), "sh", cfg_key, _shell_key(pwd))
+
+
+def store_shell_entry(cfg_path, pwd, context, deps, since):
+    """Store context resolved for PWD pwd (agreeing with getcwd) for the
+    contextual script to apply without running Python.
+
+    The script sources the entry and uses it if the config and the
+    files and directories probed deps looked into, or their parents,
+    exist as they did and are not modified after since (ns), which the
+    entry carries as its mtime. Failed resolutions and ones depending
+    on permissions are left to _contextual.py, their entry is removed.
+    """
+    entry_p = shell_entry_path(cfg_path, pwd)
+    if context is None or any(kind == "access" for kind, key, sig in deps):
+        try:
+            os.unlink(entry_p)
+        except OSError:
+            pass
+        return False
+    paths = _shell_entry_paths(cfg_path, deps)
+    created = not os.path.exists(entry_p)
+    present = sorted(p for p in paths if os.path.exists(p))
+    absent = sorted(paths.difference(present))
+    lines = [
+        "_ctx_present=({})".format(" ".join(map(_shell_quote, present))),
+        "_ctx_absent=({})".format(" ".join(map(_shell_quote, absent))),
+        "_ctx={}".format(_shell_quote(context)),
+    ]
+    tmp_p = "{}.{}.tmp".format(entry_p, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(entry_p), exist_ok=True)
+        with open(tmp_p, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.utime(tmp_p, ns=(since, since))
+        os.replace(tmp_p, entry_p)
+        if created:
+            _prune_shell_entries(os.path.dirname(entry_p))
+    except (OSError, UnicodeError):
+        # e.g. read-only cache dir or a too long file name
+        try:
+            os.unlink(tmp_p)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _shell_entry_paths(cfg_path, deps):
+    # => paths whose changes the contextual script checks for
+    paths = {os.path.abspath(cfg_path)}
+    for kind, key, sig in deps:
+        # creations and removals show in the parent mtime, writes
+        # (e.g. turning non-empty) in the entry own
+        paths.add(key)
+        paths.add(os.path.dirname(key))
+    return paths
+
+
+def shell_entry_stale(cfg_path, pwd, deps):
+    """Whether the shell entry for PWD pwd is missing or older than the
+    config or the paths probes deps looked into, then the contextual
+    script would not use it."""
+    try:
+        entry_mtime = os.stat(shell_entry_path(cfg_path, pwd)).st_mtime_ns
+    except OSError:
+        return True
+    for p in _shell_entry_paths(cfg_path, deps):
+        try:
+            if os.stat(p).st_mtime_ns > entry_mtime:
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def _prune_shell_entries(entries_d):
+    names = os.listdir(entries_d)
+    if len(names) <= MAX_CONTEXTS_ENTRIES:
+        return
+    # least recently resolved first
+    paths = [os.path.join(entries_d, name) for name in names]
+    paths.sort(key=lambda p: os.stat(p).st_mtime_ns)
+    for p in paths[: len(paths) - MAX_CONTEXTS_ENTRIES]:
+        os.unlink(p)
+
+
+def load_shortcuts(cfg_path, index):
+    """Shortcut table of config, rebuilt when a prefix listing changed."""
+    ident = config_identity(cfg_path)
+    shortcuts_p = cache_path(cfg_path, "shortcuts")
+    cached = _load(shortcuts_p, SHORTCUTS_VERSION)
+    if cached is not None:
+        cached_ident, deps, table = cached
+        if cached_ident == ident and landmark.changed_dependency(deps) is None:
+            return table
+    fs = landmark.FSCache()
+    table = landmark.shortcut_table(index, fs)
+    _store(shortcuts_p, SHORTCUTS_VERSION, (ident, fs.dependencies(), table))
+    return table
+
+
+def _captures_path():
+    # shared by configs, entries are keyed by the evaluated context
+    return os.path.join(cache_dir(), "captures")
+
+
+def _cached_captures():
+    cached = _load(_captures_path(), CAPTURES_VERSION)
+    if cached is None:
+        return {}
+    return cached[0]
+
+
+def lookup_capture(context):
+    """=> captured environment changes of evaluated context, None if
+    not captured or a file it depends on changed."""
+    entry = _cached_captures().get(context)
+    if entry is None:
+        return None
+    delta, deps = entry
+    if landmark.changed_dependency(deps) is not None:
+        return None
+    return delta
+
+
+def store_capture(context, delta, deps):
+    """Store environment changes captured running context, valid while
+    the FSCache.dependencies() deps hold."""
+    entries = dict(_cached_captures())
+    entries.pop(context, None)
+    while len(entries) >= MAX_CAPTURES:
+        del entries[next(iter(entries))]
+    entries[context] = (delta, deps)
+    return _store(_captures_path(), CAPTURES_VERSION, (entries,))
+
+
+def load_history(cfg_path):
+    """=> start directories locations resolved with config, most
+    recently used first."""
+    cached = _load(cache_path(cfg_path, "history"), HISTORY_VERSION)
+    if cached is None:
+        return []
+    return [list(locations) for locations in reversed(cached[0])]
+
+
+def record_history(cfg_path, locations):
+    """Record a resolution for start directories locations in the
+    history of config."""
+    history_p = cache_path(cfg_path, "history")
+    cached = _load(history_p, HISTORY_VERSION)
+    entries = list(cached[0]) if cached is not None else []
+    key = tuple(locations)
+    if entries and entries[-1] == key:
+        # the common case of commands run in a row, skip the write
+        return True
+    if key in entries:
+        entries.remove(key)
+    entries.append(key)
+    del entries[:-MAX_HISTORY]
+    return _store(history_p, HISTORY_VERSION, (entries,))
+
+
+def stamps_dir(cfg_path):
+    """Directory of the per-shell stamp files of config, named by shell pid."""
+    return cache_path(cfg_path, "stamps")
+
+
+def touch_stamp(cfg_path, stamp_p):
+    """Make the shell stamp file stamp_p carry the current mtime of config."""
+    cfg_path, size, mtime_ns = config_identity(cfg_path)
+    try:
+        os.makedirs(os.path.dirname(stamp_p), exist_ok=True)
+        with open(stamp_p, "a"):
+            pass
+        os.utime(stamp_p, ns=(mtime_ns, mtime_ns))
+    except OSError:
+        return None
+    return stamp_p
+
+
+def prune_stamps(cfg_path):
+    """Remove the stamp files of config of shells no longer running."""
+    stamps_d = stamps_dir(cfg_path)
+    try:
+        names = os.listdir(stamps_d)
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.kill(int(name), 0)
+            continue
+        except PermissionError:
+            continue
+        except (ValueError, OSError):
+            pass
+        try:
+            os.unlink(os.path.join(stamps_d, name))
+        except OSError:
+            pass
+
+
+def store_watch_map(cfg_path, root, contexts):
+    """Store the directory to context map kept up to date by this process."""
+    ident = config_identity(cfg_path)
+    return _store(
+        cache_path(cfg_path, "watch"),
+        WATCH_MAP_VERSION,
+        (ident, os.getpid(), root, contexts),
+    )
+
+
+def _watch_map(cfg_path):
+    cached = _load(cache_path(cfg_path, "watch"), WATCH_MAP_VERSION)
+    if cached is None:
+        return None
+    ident, pid, root, contexts = cached
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        # watcher is gone, the map is not maintained anymore
+        return None
+    except OSError:
+        pass
+    if ident != config_identity(cfg_path):
+        return None
+    return root, contexts
+
+
+def lookup_watched(cfg_path, d):
+    """Look up the context of directory d in a live watcher map.
+
+    => (status, context) with status None if there is no live map,
+    else hit or not covered.
+    """
+    watch_map = _watch_map(cfg_path)
+    if watch_map is None:
+        return None, None
+    root, contexts = watch_map
+    try:
+        return "hit", contexts[d]
+    except KeyError:
+        return "not covered", None
+
+
+def _slow_until(cfg_path):
+    cached = _load(cache_path(cfg_path, "slow"), SLOW_RULES_VERSION)
+    if cached is None:
+        return {}
+    now = time.time()
+    return {src: until for src, until in cached[0].items() if until > now}
+
+
+def slow_rules(cfg_path):
+    """=> set of the sources of config rules in their slow cool-down."""
+    return set(_slow_until(cfg_path))
+
+
+def mark_slow_rules(cfg_path, srcs, cooldown):
+    """Put the rules with the given sources in cool-down for cooldown secs."""
+    slow = _slow_until(cfg_path)
+    until = time.time() + cooldown
+    for src in srcs:
+        slow[src] = until
+    return _store(cache_path(cfg_path, "slow"), SLOW_RULES_VERSION, (slow,))
+
+
+def contexts_cache_info(cfg_path):
+    """=> list of (label, value) describing the resolved contexts cache."""
+    table = _contexts_table(cfg_path)
+    entries = 0
+    if table is not None:
+        entries = sum(
+            _read_slot(table, i) is not None
+            for i in range(MAX_CONTEXTS_ENTRIES)
+        )
+    info = [
+        ("contexts-cache", _contexts_path(cfg_path)),
+        ("contexts", entries),
+    ]
+    watch_map = _watch_map(cfg_path)
+    if watch_map is not None:
+        root, contexts = watch_map
+        info.append(("watch-map", "{} ({} directories)".format(root, len(contexts))))
+    return info
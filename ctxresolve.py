@@ -0,0 +1,718 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Context resolution for _contextual.py and the other entry points.
+
+Kept out of the _contextual.py script, which Python compiles afresh on
+every run, so that its bytecode is cached.
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+import ctxcache
+import landmark
+
+
+def _profile_match(lmark, kind, location, location_segs, fs, profile):
+    """lmark.match appending its time and work to profile."""
+    from time import perf_counter
+
+    counts = dict(fs.counts)
+    steps = dict(fs.steps)
+    fs.steps["depth"] = 0
+    start = perf_counter()
+    matched, context = lmark.match(location, location_segs, fs)
+    elapsed = perf_counter() - start
+    entry = {
+        "rule": lmark.src,
+        "start_dir": kind,
+        "matched": bool(matched),
+        "time_s": elapsed,
+        "depth": fs.steps["depth"],
+        "fs_calls": {call: n - counts[call] for call, n in fs.counts.items()},
+    }
+    for step in ("dirs", "globs", "checks"):
+        entry[step] = fs.steps[step] - steps[step]
+    fs.steps["depth"] = max(fs.steps["depth"], steps["depth"])
+    profile.append(entry)
+    return matched, context
+
+
+def infer_contexts(
+    landmarks,
+    locations,
+    tracef,
+    scan_all=False,
+    fs=None,
+    profile=None,
+    executor=None,
+    deadline=None,
+    skip=(),
+    matches=None,
+):
+    """=> [(matched, context, capture)] of the rules matching locations.
+
+    With matches given (kind, location, landmark, matched) of each
+    matching rule are appended to it, in the same order.
+    """
+    if isinstance(landmarks, landmark.LandmarkIndex):
+        index = landmarks
+    else:
+        index = landmark.LandmarkIndex(landmarks)
+    if fs is None:
+        fs = landmark.FSCache()
+    context_pairs = []
+    # use a rule only once
+    matched_rules = set()
+    skipped = set()
+    # made for the rules with their own deadline, possibly of included files
+    own_executor = None
+    try:
+        for kind, location in locations:
+            tracef("start-dir[{}]: {}", kind, location)
+            location_segs = landmark.segs(location)
+            # with scan_all full scan, rules not under location just don't match
+            candidates = index.candidates(location_segs, fs, scan_all)
+            candidates = [
+                (i, lmark) for i, lmark in candidates if i not in matched_rules
+            ]
+            if skip or fs.abandoned:
+                for i, lmark in candidates:
+                    if lmark.src in skip and i not in skipped:
+                        skipped.add(i)
+                        # the result without it must not be stored
+                        fs.complete = False
+                        print(
+                            "contextual: [rule: {}] skipped, exceeded deadline "
+                            "recently".format(lmark.src),
+                            file=sys.stderr,
+                        )
+                # included rules can be loaded afresh for each location
+                abandoned = set(lmark.src for lmark in fs.abandoned)
+                candidates = [
+                    (i, lmark)
+                    for i, lmark in candidates
+                    if i not in skipped and lmark.src not in abandoned
+                ]
+            if profile is not None:
+                results = [
+                    _profile_match(lmark, kind, location, location_segs, fs, profile)
+                    for i, lmark in candidates
+                ]
+            else:
+                if executor is None and any(lmark.deadline for i, lmark in candidates):
+                    executor = own_executor = DaemonThreadPool(DEADLINE_THREADS)
+                # one walk up from location for all rules
+                results = landmark.match_all(
+                    [lmark for i, lmark in candidates],
+                    location,
+                    location_segs,
+                    fs,
+                    executor,
+                    deadline,
+                )
+            for (i, lmark), (matched, context) in zip(candidates, results):
+                if matched:
+                    matched_rules.add(i)
+                    if matches is not None:
+                        matches.append((kind, location, lmark, matched))
+                _add_context(context_pairs, lmark, matched, context, tracef)
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+    return context_pairs
+
+
+def _add_context(context_pairs, lmark, matched, context, tracef):
+    if matched:
+        if context:
+            tracef(" ~~ {} => {}", lmark.src, matched)
+            context_pairs.append((matched, context, lmark.capture))
+        else:
+            # void context
+            tracef(" ~~ {} => void_context", lmark.src)
+            context_pairs.append((None, None, False))
+    else:
+        tracef(" ~~ {} => no", lmark.src)
+
+
+def cache_command(cfg_path, args):
+    if args and args[0] == "rebuild":
+        ctxcache.load_landmarks(cfg_path, rebuild=True)
+    elif args:
+        print(
+            "contextual: unknown :cache subcommand {!r}".format(args[0]),
+            file=sys.stderr,
+        )
+        print("exit 1", file=sys.stdout)
+        sys.exit(1)
+    info = ctxcache.rules_cache_info(cfg_path)
+    info.extend(ctxcache.contexts_cache_info(cfg_path))
+    for label, value in info:
+        print("{}: {}".format(label, value), file=sys.stderr)
+    print("exit 0", file=sys.stdout)
+    sys.exit(0)
+
+
+HOOK_FUNCTION = """\
+_contextual_hook() {
+    if [[ "$PWD" != "$_contextual_hook_pwd" || %(cfg)s -nt "$_CONTEXTUAL_STAMP" ||
+          %(cfg)s -ot "$_CONTEXTUAL_STAMP" ]] ; then
+        _contextual_hook_pwd=$PWD
+        if _CONTEXTUAL_CTX=$(_contextual.py %(cfg)s :hook resolve 2>/dev/null)
+        then
+            export _CONTEXTUAL_PWD="$PWD" _CONTEXTUAL_CTX
+        else
+            unset _CONTEXTUAL_PWD _CONTEXTUAL_CTX
+        fi
+    fi
+}
+unset _CONTEXTUAL_PWD _CONTEXTUAL_CTX
+export _CONTEXTUAL_CFG=%(cfg)s _CONTEXTUAL_STAMP=%(stamps)s/$$
+"""
+
+HOOK_INSTALL = {
+    "bash": """\
+case ";${PROMPT_COMMAND};" in
+    *";_contextual_hook;"*) ;;
+    *) PROMPT_COMMAND="_contextual_hook${PROMPT_COMMAND:+;$PROMPT_COMMAND}" ;;
+esac
+""",
+    "zsh": """\
+autoload -Uz add-zsh-hook
+add-zsh-hook chpwd _contextual_hook
+_contextual_hook
+""",
+}
+
+
+def hook_command(cfg_path, args, environ=os.environ):
+    if args == ["resolve"]:
+        # the stamp of the calling shell carries the config mtime its
+        # context was resolved with
+        stamp_p = environ.get("_CONTEXTUAL_STAMP")
+        if stamp_p:
+            ctxcache.touch_stamp(cfg_path, stamp_p)
+        return
+    if len(args) != 1 or args[0] not in HOOK_INSTALL:
+        print("usage: _contextual.py conf :hook bash|zsh", file=sys.stderr)
+        sys.exit(2)
+    import shlex
+
+    cfg_path = os.path.abspath(cfg_path)
+    subst = {
+        "cfg": shlex.quote(cfg_path),
+        "stamps": shlex.quote(ctxcache.stamps_dir(cfg_path)),
+    }
+    ctxcache.prune_stamps(cfg_path)
+    print(HOOK_FUNCTION % subst + HOOK_INSTALL[args[0]], end="")
+    sys.exit(0)
+
+
+def evaluate_context(matched, context, capture, fs):
+    """=> evaluated context of a matching rule, None if void or broken."""
+    if not context:
+        return None
+    try:
+        context = context.format(*matched, ctx_dir=matched[0])
+    except (IndexError, KeyError):
+        # keep reporting the error
+        fs.complete = False
+        print(
+            "contextual: {!r} has unbound/unknown placeholder".format(context),
+            file=sys.stderr,
+        )
+        return None
+    if capture:
+        # empty if it changes nothing
+        context = captured_context(context, matched, fs)
+    return context
+
+
+def evaluate_contexts(context_pairs, fs):
+    contexts = []
+    # reverse so that early rules context effects have precedence
+    for matched, context, capture in reversed(context_pairs):
+        context = evaluate_context(matched, context, capture, fs)
+        if context:
+            contexts.append(context)
+    return ";".join(contexts)
+
+
+# runs the context, environments before and after separated by an empty entry
+CAPTURE_SCRIPT = """\
+env -0
+printf '\\0'
+eval "$1" >/dev/null </dev/null || exit
+env -0
+"""
+# variables bash itself maintains
+CAPTURE_IGNORED = {"_", "SHLVL", "PWD", "OLDPWD"}
+
+
+def capture_env_delta(context, ctx_dir):
+    """=> shell code making the environment changes that running
+    context in bash from ctx_dir makes, None if it failed."""
+    import re
+    import shlex
+    import subprocess
+
+    try:
+        out = subprocess.run(
+            ["/bin/bash", "-c", CAPTURE_SCRIPT, "bash", context],
+            cwd=ctx_dir,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    entries = os.fsdecode(out).split("\0")
+    sep = entries.index("")
+    before, after = [
+        dict(entry.split("=", 1) for entry in env if "=" in entry)
+        for env in (entries[:sep], entries[sep + 1 :])
+    ]
+    name_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+    delta = []
+    for name in sorted(set(before) | set(after)):
+        if name in CAPTURE_IGNORED or not name_re.match(name):
+            continue
+        old = before.get(name)
+        new = after.get(name)
+        if new == old:
+            continue
+        if new is None:
+            delta.append("unset {}".format(name))
+        elif old and new.endswith(old):
+            # e.g. PATH prepended to, stay relative to the current value
+            prefix = shlex.quote(new[: -len(old)])
+            delta.append('export {}={}"${}"'.format(name, prefix, name))
+        elif old and new.startswith(old):
+            suffix = shlex.quote(new[len(old) :])
+            delta.append('export {}="${}"{}'.format(name, name, suffix))
+        else:
+            delta.append("export {}={}".format(name, shlex.quote(new)))
+    return ";".join(delta)
+
+
+def _capture_files(context, matched):
+    # files whose content can change what running context does: the
+    # landmarks matched and the files named in context, e.g. sourced
+    import shlex
+
+    try:
+        words = shlex.split(context)
+    except ValueError:
+        words = []
+    files = [p for p in matched[1:] if os.path.isabs(p)]
+    for word in words:
+        p = os.path.expanduser(word)
+        if os.path.isabs(p) and os.path.isfile(p):
+            files.append(p)
+    return files
+
+
+def captured_context(context, matched, fs):
+    """=> captured environment changes of running evaluated context,
+    context itself if they cannot be captured.
+
+    Captures are reused until one of the files context depends on
+    changes, fs records them for the resolution as well.
+    """
+    files = _capture_files(context, matched)
+    for p in files:
+        fs.mtime(p)
+    delta = ctxcache.lookup_capture(context)
+    if delta is not None:
+        return delta
+    # recorded before running, changes made meanwhile are noticed next time
+    capture_fs = landmark.FSCache()
+    for p in files:
+        capture_fs.mtime(p)
+    deps = capture_fs.dependencies()
+    delta = capture_env_delta(context, matched[0])
+    if delta is None:
+        fs.complete = False
+        print(
+            "contextual: {!r} failed, not captured".format(context), file=sys.stderr
+        )
+        return context
+    ctxcache.store_capture(context, delta, deps)
+    return delta
+
+
+class DaemonThreadPool(object):
+    """Minimal executor whose worker threads are daemon threads.
+
+    Unlike with ThreadPoolExecutor, workers stuck in probes of a stalled
+    mount don't keep the process from exiting.
+    """
+
+    def __init__(self, threads):
+        import queue
+        import threading
+
+        self.threads = threads
+        self._queue = queue.SimpleQueue()
+        for i in range(threads):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, fn, *args):
+        from concurrent.futures import Future
+
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def _work(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+            future, fn, args = work
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                res = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(res)
+
+    def shutdown(self):
+        for i in range(self.threads):
+            self._queue.put(None)
+
+
+# probe threads used for deadlines if CONTEXTUAL_THREADS is not larger
+DEADLINE_THREADS = 8
+
+
+def _call_by_deadline(deadline, fn, *args):
+    """=> fn(*args), None if not done by deadline (a time.monotonic())."""
+    import threading
+    from time import monotonic
+
+    res = []
+    thread = threading.Thread(target=lambda: res.append(fn(*args)), daemon=True)
+    thread.start()
+    thread.join(max(0, deadline - monotonic()))
+    return res[0] if res else None
+
+
+def _executor(threads, deadline):
+    # => executor for the landmark probes, None to make them serially;
+    # infer_contexts makes one for rules with their own deadline
+    if threads > 1:
+        return DaemonThreadPool(threads)
+    if deadline is not None:
+        return DaemonThreadPool(DEADLINE_THREADS)
+    return None
+
+
+def resolve_uncached(
+    index, locations, tracef, scan_all=False, threads=0, deadline=None, skip=()
+):
+    """=> (total evaluated context or None, FSCache with the probes made).
+
+    With threads > 1 landmark probes are made concurrently by that many
+    threads, for file systems with high latency. Rules whose probes are
+    not done by deadline (a time.monotonic() value) or their own
+    deadline don't match, they end up in fs.abandoned. Rules with
+    source in skip don't match either.
+    """
+    fs = landmark.FSCache()
+    executor = _executor(threads, deadline)
+    try:
+        context_pairs = infer_contexts(
+            index,
+            locations,
+            tracef,
+            scan_all=scan_all,
+            fs=fs,
+            executor=executor,
+            deadline=deadline,
+            skip=skip,
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    total_context = None
+    if context_pairs:
+        total_context = evaluate_contexts(context_pairs, fs)
+    return total_context, fs
+
+
+def _shell_pwd(locations):
+    # PWD the contextual script can look up stored resolutions for
+    if len(locations) == 2:
+        (kind, pwd), (cwd_kind, cwd) = locations
+        if kind == "PWD" and pwd == cwd:
+            return pwd
+    return None
+
+
+# resolution settings from the environment: (variable, setting, type)
+SETTINGS = [
+    ("CONTEXTUAL_THREADS", "threads", int),
+    ("CONTEXTUAL_DEADLINE", "deadline", float),
+    ("CONTEXTUAL_SLOW_COOLDOWN", "cooldown", float),
+]
+
+
+def settings_from(environ):
+    """=> resolution settings dict from the environment."""
+    settings = {}
+    for var, setting, convert in SETTINGS:
+        try:
+            settings[setting] = convert(environ.get(var) or 0)
+        except ValueError:
+            settings[setting] = convert(0)
+    return settings
+
+
+def _trace_nothing(*a):
+    pass
+
+
+class RuleMatch(object):
+    """A rule matched by Resolver.resolve."""
+
+    def __init__(self, rule, start_dir, matched, context):
+        # source line of the rule
+        self.rule = rule
+        # (kind, directory) it matched for
+        self.start_dir = start_dir
+        # values of the placeholders {0} (the context directory), {1}...
+        self.placeholders = matched
+        self.ctx_dir = matched[0]
+        # evaluated context, None for void ones
+        self.context = context
+
+    def as_dict(self):
+        return {
+            "rule": self.rule,
+            "start_dir": list(self.start_dir),
+            "ctx_dir": self.ctx_dir,
+            "placeholders": list(self.placeholders),
+            "context": self.context,
+        }
+
+
+class Resolution(object):
+    """Outcome of Resolver.resolve: the matched rules in matching order
+    and the total context as applied, None if no rule matched."""
+
+    def __init__(self, matches, context):
+        self.matches = matches
+        self.context = context
+
+    def as_dict(self):
+        return {
+            "matches": [match.as_dict() for match in self.matches],
+            "context": self.context,
+        }
+
+
+class Resolver(object):
+    """Resolve contexts of a config in process, e.g. for editors and tools.
+
+    The parsed rules are kept, and for resolve() the file system probes
+    made as well, across calls until invalidate().
+    """
+
+    def __init__(self, cfg_path, settings=None, tracef=None):
+        self.cfg_path = cfg_path
+        self.settings = settings or {}
+        self.tracef = tracef or _trace_nothing
+        self._index = None
+        self.fs = landmark.FSCache()
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = ctxcache.load_index(self.cfg_path)
+        return self._index
+
+    def invalidate(self, rules=False):
+        """Forget the probes made so far, e.g. after being notified of
+        file changes, with rules also the rules (reparsed if changed)."""
+        self.fs = landmark.FSCache()
+        if rules:
+            self._index = None
+
+    def _deadline(self):
+        if not self.settings.get("deadline"):
+            return None
+        from time import monotonic
+
+        return monotonic() + self.settings["deadline"]
+
+    def resolve(self, start_dirs):
+        """=> Resolution for start directories start_dirs, in order.
+
+        start_dirs are directories or (kind, directory) pairs. The
+        persistent caches are not used, probes are served from the ones
+        made by previous calls.
+        """
+        locations = [d if isinstance(d, tuple) else ("dir", d) for d in start_dirs]
+        # rules given up on are tried again, unlike the probes made
+        self.fs.abandoned = []
+        self.fs.complete = True
+        deadline = self._deadline()
+        executor = _executor(self.settings.get("threads", 0), deadline)
+        matches = []
+        try:
+            infer_contexts(
+                self.index,
+                locations,
+                self.tracef,
+                fs=self.fs,
+                executor=executor,
+                deadline=deadline,
+                matches=matches,
+            )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        rule_matches = []
+        for kind, location, lmark, matched in matches:
+            context = evaluate_context(matched, lmark.context, lmark.capture, self.fs)
+            match = RuleMatch(lmark.src, (kind, location), matched, context)
+            rule_matches.append(match)
+        total_context = None
+        if rule_matches:
+            # early rules context effects have precedence
+            contexts = [match.context for match in reversed(rule_matches)]
+            total_context = ";".join(context for context in contexts if context)
+        return Resolution(rule_matches, total_context)
+
+    def context(self, locations, trace=False):
+        """=> total evaluated context for locations, None if no rule
+        matched, using and updating the persistent caches."""
+        from time import time_ns
+
+        cfg_path = self.cfg_path
+        tracef = self.tracef
+        # probes happen after this
+        since = time_ns()
+        deadline = self._deadline()
+        start_dirs = set(location for kind, location in locations)
+        if len(start_dirs) == 1:
+            status, total_context = ctxcache.lookup_watched(cfg_path, start_dirs.pop())
+            if status is not None:
+                tracef("watch-map: {}", status)
+            if status == "hit" and not trace:
+                return total_context
+        if deadline is None:
+            lookup = ctxcache.lookup_context_deps(cfg_path, locations)
+        else:
+            # checking cached entries probes the file system as well
+            lookup = _call_by_deadline(
+                deadline, ctxcache.lookup_context_deps, cfg_path, locations
+            )
+            if lookup is None:
+                lookup = ("abandoned", "exceeded deadline", None, None)
+        status, detail, total_context, deps = lookup
+        if detail:
+            status = "{} ({})".format(status, detail)
+        tracef("resolution-cache: {}", status)
+        pwd = _shell_pwd(locations)
+        if status == "hit" and not trace:
+            # e.g. :hook resolve runs with a usable entry
+            if pwd is not None and ctxcache.shell_entry_stale(cfg_path, pwd, deps):
+                ctxcache.store_shell_entry(cfg_path, pwd, total_context, deps, since)
+            return total_context
+        cooldown = self.settings.get("cooldown")
+        skip = ctxcache.slow_rules(cfg_path) if cooldown else ()
+        total_context, fs = resolve_uncached(
+            self.index,
+            locations,
+            tracef,
+            scan_all=trace,
+            threads=self.settings.get("threads", 0),
+            deadline=deadline,
+            skip=skip,
+        )
+        if fs.abandoned and cooldown:
+            srcs = [lmark.src for lmark in fs.abandoned]
+            ctxcache.mark_slow_rules(cfg_path, srcs, cooldown)
+        ctxcache.store_context(cfg_path, locations, total_context, fs)
+        if pwd is not None:
+            shell_context = total_context if fs.complete else None
+            deps = fs.dependencies()
+            ctxcache.store_shell_entry(cfg_path, pwd, shell_context, deps, since)
+        return total_context
+
+    def shortcut(self, shortcut):
+        """=> total evaluated context of the rules matching shortcut, or None."""
+        index = self.index
+        table = ctxcache.load_shortcuts(self.cfg_path, index)
+        self.tracef("shortcut: @{}", shortcut)
+        # /* and /** rules are indexed by the first segment
+        first_seg = shortcut.split("/")[0]
+        candidates = set(table.get(first_seg, ())) | set(table.get(shortcut, ()))
+        fs = landmark.FSCache()
+        context_pairs = []
+        for key in sorted(candidates):
+            try:
+                lmark = index.landmark_at(key)
+            except (OSError, IndexError):
+                # an included file changed since the table was checked
+                continue
+            matched, context = lmark.match_shortcut(shortcut, None, fs)
+            _add_context(context_pairs, lmark, matched, context, self.tracef)
+        if not context_pairs:
+            return None
+        return evaluate_contexts(context_pairs, fs)
+
+    def profile(self, locations, trace=False):
+        """=> (total evaluated context or None, profile report), bypassing
+        caches."""
+        from time import perf_counter
+
+        cfg_path = self.cfg_path
+        start = perf_counter()
+        with open(cfg_path) as f:
+            landmarks = landmark.parse(f, os.path.dirname(os.path.abspath(cfg_path)))
+        parsed = perf_counter()
+        index = landmark.LandmarkIndex(landmarks)
+        indexed = perf_counter()
+        fs = landmark.FSCache()
+        per_rule = []
+        context_pairs = infer_contexts(
+            index, locations, self.tracef, scan_all=trace, fs=fs, profile=per_rule
+        )
+        total_context = None
+        if context_pairs:
+            total_context = evaluate_contexts(context_pairs, fs)
+        end = perf_counter()
+        report = {
+            "parse_s": parsed - start,
+            "index_s": indexed - parsed,
+            "match_s": end - indexed,
+            "total_s": end - start,
+            "rules": len(landmarks),
+            "fs_calls": fs.counts,
+            "steps": fs.steps,
+            "per_rule": per_rule,
+        }
+        return total_context, report
@@ -21,20 +21,26 @@ Parse directory landmark to context definitions, directory landmark matching.
 """
 from __future__ import print_function
 
-from functools import partial
-import glob
 import os
-import shlex
+import stat
 import sys
 
 LANDMARK_CHECKS = {}
+# checks whose results can be memoized per path during one resolution
+MEMOIZED_CHECKS = set()
 
 
-def register_check(syn):
-    """Register syntax (e.g. -e) to check(path) function."""
+def register_check(syn, memoize=False):
+    """Register syntax (e.g. -e) to check(path) function.
+
+    With memoize true check results are reused per path during one
+    resolution when matching with a FSCache.
+    """
 
     def _register(check):
         LANDMARK_CHECKS[syn] = check
+        if memoize:
+            MEMOIZED_CHECKS.add(check)
         return check
 
     return _register
@@ -55,27 +61,390 @@ def check_is_executable(p):
     return os.access(p, os.X_OK)
 
 
+def _fs_is_dir(p, fs):
+    return fs.file_type(p) == stat.S_IFDIR
+
+
+def _fs_exists(p, fs):
+    return fs.file_type(p) is not None
+
+
+def _fs_is_file(p, fs):
+    return fs.file_type(p) == stat.S_IFREG
+
+
+def _fs_is_non_empty(p, fs):
+    st = fs.stat(p)
+    return st is not None and stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+
+def _fs_is_executable(p, fs):
+    return fs.access(p, os.X_OK)
+
+
+# builtin checks in terms of FSCache probes
+FS_CHECKS = {
+    os.path.isdir: _fs_is_dir,
+    os.path.exists: _fs_exists,
+    os.path.isfile: _fs_is_file,
+    check_is_non_empty: _fs_is_non_empty,
+    check_is_executable: _fs_is_executable,
+}
+
+
+def _has_magic(s):
+    # as glob.has_magic, without importing glob and re
+    return "*" in s or "?" in s or "[" in s
+
+
+def _entry_type(entry):
+    # file type of a DirEntry not following symlinks, from d_type
+    # where available, None if it cannot be determined
+    try:
+        if entry.is_symlink():
+            return stat.S_IFLNK
+        if entry.is_dir(follow_symlinks=False):
+            return stat.S_IFDIR
+        if entry.is_file(follow_symlinks=False):
+            return stat.S_IFREG
+        return stat.S_IFMT(entry.stat(follow_symlinks=False).st_mode)
+    except OSError:
+        return None
+
+
+def _stat_sig(st):
+    # what builtin checks can observe of a file system entry
+    if st is None:
+        return None
+    return st.st_mode, st.st_size > 0
+
+
+# distinct paths probed in a directory before listing it instead
+LIST_AFTER_PROBES = 4
+
+
+class FSCache(object):
+    """Memoize file system probes for the duration of one resolution."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lstats = {}
+        self._access = {}
+        self._listdirs = {}
+        # files whose content matters, e.g. sourced by captured contexts
+        self._mtimes = set()
+        # file types of the non-symlink entries of successfully listed dirs
+        self._entry_types = {}
+        self._listed = set()
+        self._probed = {}
+        self._globs = {}
+        self._checks = {}
+        # whether the recorded probes fully determine the outcome
+        self.complete = True
+        # landmarks given up on for exceeding their deadline
+        self.abandoned = []
+        # file system calls actually made, and glob patterns expanded
+        self.counts = dict.fromkeys(["stat", "lstat", "access", "scandir", "glob"], 0)
+        # matching work: candidate directories tested, condition glob
+        # expansions, check calls and deepest condition reached
+        self.steps = dict.fromkeys(["dirs", "globs", "checks", "depth"], 0)
+
+    def stat(self, p):
+        """=> os.stat(p) or None if it fails."""
+        try:
+            return self._stats[p]
+        except KeyError:
+            pass
+        try:
+            self.counts["stat"] += 1
+            st = os.stat(p)
+        except (OSError, ValueError):
+            st = None
+        self._stats[p] = st
+        return st
+
+    def _snapshot_type(self, p):
+        # => file type of p (not following symlinks) from a listing of
+        # its directory, 0 if not there, None if not listed
+        try:
+            return self._entry_types[p]
+        except KeyError:
+            pass
+        d, name = os.path.split(p)
+        if not name or os.path.join(d, name) != p:
+            # not spelled as listing entries are, e.g. x/ or x//y
+            return None
+        if d not in self._listed:
+            probed = self._probed.setdefault(d, set())
+            probed.add(p)
+            if len(probed) <= LIST_AFTER_PROBES:
+                return None
+            # many rules look into d, one listing is cheaper
+            self.listdir(d)
+            if d not in self._listed:
+                return None
+        return self._entry_types.get(p, 0)
+
+    def file_type(self, p):
+        """=> stat.S_IFMT of p following symlinks, None if it does not exist."""
+        ftype = self._snapshot_type(p)
+        if ftype == 0:
+            return None
+        if ftype is None or ftype == stat.S_IFLNK:
+            st = self.stat(p)
+            if st is None:
+                return None
+            ftype = stat.S_IFMT(st.st_mode)
+        return ftype
+
+    def lexists(self, p):
+        ftype = self._snapshot_type(p)
+        if ftype is not None:
+            return ftype != 0
+        if self.stat(p) is not None:
+            return True
+        try:
+            return self._lstats[p] is not None
+        except KeyError:
+            pass
+        try:
+            self.counts["lstat"] += 1
+            st = os.lstat(p)
+        except (OSError, ValueError):
+            st = None
+        self._lstats[p] = st
+        return st is not None
+
+    def mtime(self, p):
+        """=> modification time in ns of p, None if it does not exist.
+
+        Unlike for other probes a later change of it is a changed dependency.
+        """
+        self._mtimes.add(p)
+        st = self.stat(p)
+        return st and st.st_mtime_ns
+
+    def access(self, p, mode):
+        key = (p, mode)
+        try:
+            return self._access[key]
+        except KeyError:
+            self.counts["access"] += 1
+            res = self._access[key] = os.access(p, mode)
+            return res
+
+    def listdir(self, d):
+        """=> [(name, is_dir)] for entries of directory d, [] if unlistable."""
+        try:
+            return self._listdirs[d]
+        except KeyError:
+            pass
+        # stat before listing, so recorded mtime can only be older
+        self.stat(d)
+        entries = []
+        self.counts["scandir"] += 1
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    ftype = _entry_type(entry)
+                    if ftype == stat.S_IFLNK:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                    else:
+                        is_dir = ftype == stat.S_IFDIR
+                    if ftype is not None:
+                        self._entry_types[entry.path] = ftype
+                    entries.append((entry.name, is_dir))
+            self._listed.add(d)
+        except OSError:
+            entries = []
+        self._listdirs[d] = entries
+        return entries
+
+    def glob(self, pattern, dironly=False):
+        """=> glob.glob(pattern) computed from cached probes."""
+        key = (pattern, dironly)
+        try:
+            return self._globs[key]
+        except KeyError:
+            pass
+        self.counts["glob"] += 1
+        dirname, basename = os.path.split(pattern)
+        if not _has_magic(pattern):
+            if basename:
+                res = [pattern] if self.lexists(pattern) else []
+            else:
+                res = [pattern] if _fs_is_dir(dirname, self) else []
+            self._globs[key] = res
+            return res
+        if dirname != pattern and _has_magic(dirname):
+            dirs = self.glob(dirname, True)
+        else:
+            dirs = [dirname]
+        import fnmatch
+
+        res = []
+        for d in dirs:
+            if _has_magic(basename):
+                names = [
+                    name for name, is_dir in self.listdir(d) if is_dir or not dironly
+                ]
+                if basename[0] != ".":
+                    names = [name for name in names if name[0] != "."]
+                names = fnmatch.filter(names, basename)
+            elif basename:
+                names = [basename] if self.lexists(os.path.join(d, basename)) else []
+            else:
+                names = [basename] if _fs_is_dir(d, self) else []
+            res.extend(os.path.join(d, name) for name in names)
+        self._globs[key] = res
+        return res
+
+    def check(self, check, p):
+        """=> check(p) using cached probes for builtin/memoized checks."""
+        fs_check = FS_CHECKS.get(check)
+        if fs_check is not None:
+            return fs_check(p, self)
+        # outcome depends on probes we cannot record
+        self.complete = False
+        if check not in MEMOIZED_CHECKS:
+            return check(p)
+        key = (check, p)
+        try:
+            return self._checks[key]
+        except KeyError:
+            res = self._checks[key] = check(p)
+            return res
+
+    def dependencies(self):
+        """=> [(probe kind, key, result signature)] of the recorded probes."""
+        # copied first, probes of concurrent tests no longer needed may
+        # still be going on
+        stats = list(self._stats.items())
+        lstats = list(self._lstats.items())
+        access = list(self._access.items())
+        listdirs = list(self._listdirs)
+        mtimes = list(self._mtimes)
+        deps = [("stat", p, _stat_sig(st)) for p, st in stats]
+        deps.extend(("lstat", p, st is not None) for p, st in lstats)
+        deps.extend(("access", key, res) for key, res in access)
+        for d in listdirs:
+            st = self._stats[d]
+            deps.append(("listdir", d, st and st.st_mtime_ns))
+        for p in mtimes:
+            st = self._stats[p]
+            deps.append(("mtime", p, st and st.st_mtime_ns))
+        return deps
+
+
+def changed_dependency(deps):
+    """=> first of FSCache.dependencies() deps not holding anymore or None."""
+    fs = FSCache()
+    for dep in deps:
+        kind, key, sig = dep
+        if kind == "stat":
+            now = _stat_sig(fs.stat(key))
+        elif kind == "lstat":
+            now = fs.lexists(key)
+        elif kind == "access":
+            now = fs.access(*key)
+        else:
+            # listdir and mtime
+            st = fs.stat(key)
+            now = st and st.st_mtime_ns
+        if now != sig:
+            return dep
+    return None
+
+
 class LandmarkError(Exception):
     """Error while fulfilling landmark clause"""
 
 
+def _split_template(relative):
+    """=> (list of literal strings and placeholder indexes, highest index)."""
+    from string import Formatter
+
+    unknown = LandmarkError("{!r} has unbound/unknown placeholder".format(relative))
+    parts = []
+    max_index = -1
+    try:
+        fields = list(Formatter().parse(relative))
+    except ValueError:
+        raise unknown
+    # {} are numbered in order, as by str.format, not mixed with {N}
+    auto = 0
+    manual = False
+    for literal, field, spec, conversion in fields:
+        if literal:
+            parts.append(literal)
+        if field is None:
+            continue
+        if field in ("ctxdir", "ctx_dir"):
+            index = 0
+        elif field == "":
+            if manual:
+                raise unknown
+            index = auto
+            auto += 1
+        elif field.isdigit():
+            if auto:
+                raise unknown
+            manual = True
+            index = int(field)
+        else:
+            raise unknown
+        if spec or conversion:
+            raise unknown
+        parts.append(index)
+        max_index = max(max_index, index)
+    return parts, max_index
+
+
 class LandmarkCond(object):
     """Represents and tests for one directory landmark condition."""
 
     def __init__(self, check, relative):
         self.check = check
         self.relative = relative
-
-    def matching(self, matched):
+        # evaluation plan: the path template split once, placeholder
+        # free paths are used as they are
+        self.parts, self.max_index = _split_template(relative)
+        self.literal = relative if self.max_index < 0 else None
+        # without wildcards (placeholder values are taken literally) a
+        # single path is checked, no globbing
+        pattern = "".join(part for part in self.parts if type(part) is str)
+        self.single = not _has_magic(pattern) and not relative.endswith("/")
+
+    def matching(self, matched, fs=None):
         p = matched[0]
-        try:
-            rel = self.relative.format(*matched, ctxdir=p)
-        except (IndexError, KeyError):
-            raise LandmarkError(
-                "{!r} has unbound/unknown placeholder".format(self.relative)
-            )
-        for cand in glob.glob(os.path.join(p, rel)):
-            if self.check(cand):
+        rel = self.literal
+        if rel is None:
+            try:
+                rel = "".join(
+                    part if type(part) is str else matched[part] for part in self.parts
+                )
+            except IndexError:
+                raise LandmarkError(
+                    "{!r} has unbound/unknown placeholder".format(self.relative)
+                )
+        if fs is None:
+            fs = FSCache()
+        if self.single:
+            cand = os.path.join(p, rel)
+            fs.steps["checks"] += 1
+            # builtin checks are false for missing paths anyway
+            if self.check not in FS_CHECKS and not fs.lexists(cand):
+                return
+            if fs.check(self.check, cand):
+                yield cand
+            return
+        fs.steps["globs"] += 1
+        for cand in fs.glob(os.path.join(p, rel)):
+            fs.steps["checks"] += 1
+            if fs.check(self.check, cand):
                 yield cand
 
 
@@ -86,26 +455,36 @@ class LandmarkClause(object):
         self.conds = []
 
     def push_cond(self, check, relative):
-        self.conds.append(LandmarkCond(check, relative))
+        cond = LandmarkCond(check, relative)
+        # {0} is the context dir, {1}... the matches of the conds before
+        if cond.max_index > len(self.conds):
+            raise LandmarkError(
+                "{!r} has unbound/unknown placeholder".format(relative)
+            )
+        self.conds.append(cond)
 
-    def find_matches(self, cond_index, matched):
+    def find_matches(self, cond_index, matched, fs):
+        if cond_index > fs.steps["depth"]:
+            fs.steps["depth"] = cond_index
         if cond_index >= len(self.conds):
             return matched
         cond = self.conds[cond_index]
-        for cand in cond.matching(matched):
-            got = self.find_matches(cond_index + 1, matched + [cand])
+        for cand in cond.matching(matched, fs):
+            got = self.find_matches(cond_index + 1, matched + [cand], fs)
             if got:
                 return got
         return None
 
-    def test(self, p):
-        return self.find_matches(0, [p])
+    def test(self, p, fs=None):
+        if fs is None:
+            fs = FSCache()
+        return self.find_matches(0, [p], fs)
 
 
 class Succeed(object):
     """Always test true."""
 
-    def test(self, p):
+    def test(self, p, fs=None):
         return [p]
 
 
@@ -126,7 +505,9 @@ class TooUnconstrained(Exception):
 class Landmark(object):
     """Directory landmark representation and matching a.k.a context rule."""
 
-    def __init__(self, prefix, wildcard_descendant, where, context):
+    def __init__(
+        self, prefix, wildcard_descendant, where, context, deadline=None, capture=False
+    ):
         if prefix is None:
             self.prefix_segs = []
             wildcard_descendant = "rec"
@@ -139,33 +520,44 @@ class Landmark(object):
         self.wildcard_descendant = wildcard_descendant
         self.where = where
         self.context = context
+        self.deadline = deadline
+        # replay the environment changes of context instead of running it
+        self.capture = capture
 
-    def _test_landmarks(self, p):
+    def _test_landmarks(self, p, fs=None):
         try:
-            return self.where.test(p)
+            return self.where.test(p, fs)
         except LandmarkError as e:
+            if fs is not None:
+                # keep reporting the error
+                fs.complete = False
             print("contextual: [rule: {}] {}".format(self.src, e), file=sys.stderr)
             return None
 
-    def match_shortcut(self, shortcut, _):
+    def match_shortcut(self, shortcut, _, fs=None):
+        if fs is None:
+            fs = FSCache()
         if self.wildcard_descendant:
             lmark_p = os.path.join("/", "/".join(self.prefix_segs), shortcut)
-            if not os.path.isdir(lmark_p):
+            if not fs.check(os.path.isdir, lmark_p):
                 return None, None
         else:
             shortcut_segs = segs(shortcut)
             if shortcut_segs != self.prefix_segs[-len(shortcut_segs) :]:  # noqa
                 return None, None
             lmark_p = os.path.join("/", "/".join(self.prefix_segs))
-        matched = self._test_landmarks(lmark_p)
+        fs.steps["dirs"] += 1
+        matched = self._test_landmarks(lmark_p, fs)
         if matched:
             return matched, self.context
         return None, None
 
-    def match(self, p, p_segs):
+    def levels(self, p_segs):
+        """=> (start, up_to) number of p_segs segments of the candidate
+        context directories, None if there are none."""
         n_prefix_segs = len(self.prefix_segs)
         if p_segs[0:n_prefix_segs] != self.prefix_segs:
-            return None, None
+            return None
         if self.wildcard_descendant is None:
             up_to = start = n_prefix_segs
         elif self.wildcard_descendant == "one":
@@ -173,28 +565,315 @@ class Landmark(object):
         elif self.wildcard_descendant == "rec":
             start = n_prefix_segs
             up_to = len(p_segs)
-        i = up_to
-        while i >= start and i <= len(p_segs):
+        if up_to > len(p_segs):
+            return None
+        return start, up_to
+
+    def match(self, p, p_segs, fs=None):
+        if fs is None:
+            fs = FSCache()
+        levels = self.levels(p_segs)
+        if levels is None:
+            return None, None
+        start, i = levels
+        while i >= start:
             lmark_p = os.path.join("/", "/".join(p_segs[0:i]))
-            matched = self._test_landmarks(lmark_p)
+            fs.steps["dirs"] += 1
+            matched = self._test_landmarks(lmark_p, fs)
             if matched:
                 return matched, self.context
             i -= 1
         return None, None
 
 
-def parse(cfg_lines):
-    """Parse config lines into directory landmark to context definitions."""
+def match_all(landmarks, p, p_segs, fs=None, executor=None, deadline=None):
+    """=> [lmark.match(p, p_segs, fs) for lmark in landmarks].
+
+    Walks up from p once testing at each ancestor all the landmarks
+    which can still have their context directory there. With an
+    executor (e.g. a ThreadPoolExecutor) all the candidates are tested
+    concurrently instead.
+
+    With an executor, landmarks whose tests are not done by deadline
+    (a time.monotonic() value) or their own deadline (in seconds from
+    now) are abandoned: they don't match and are added to fs.abandoned.
+    """
+    if fs is None:
+        fs = FSCache()
+    if executor is not None:
+        return _match_all_concurrently(landmarks, p_segs, fs, executor, deadline)
+    results = [(None, None)] * len(landmarks)
+    pending = []
+    for j, lmark in enumerate(landmarks):
+        levels = lmark.levels(p_segs)
+        if levels is not None:
+            pending.append((levels, j))
+    i = len(p_segs)
+    while pending:
+        lmark_p = os.path.join("/", "/".join(p_segs[0:i]))
+        still_pending = []
+        for levels, j in pending:
+            start, up_to = levels
+            if i > up_to:
+                still_pending.append((levels, j))
+                continue
+            fs.steps["dirs"] += 1
+            lmark = landmarks[j]
+            matched = lmark._test_landmarks(lmark_p, fs)
+            if matched:
+                results[j] = (matched, lmark.context)
+            elif i > start:
+                still_pending.append((levels, j))
+        pending = still_pending
+        i -= 1
+    return results
+
+
+def _match_all_concurrently(landmarks, p_segs, fs, executor, deadline):
+    import concurrent.futures
+    from time import monotonic
+
+    began = monotonic()
+    candidates = []
+    for lmark in landmarks:
+        levels = lmark.levels(p_segs)
+        if levels is None:
+            candidates.append(range(0))
+        else:
+            start, up_to = levels
+            candidates.append(range(up_to, start - 1, -1))
+    # submit the nearest candidates first, they are looked at first
+    tests = {}
+    for i in range(len(p_segs), -1, -1):
+        lmark_p = os.path.join("/", "/".join(p_segs[0:i]))
+        for j, levels in enumerate(candidates):
+            if i in levels:
+                fs.steps["dirs"] += 1
+                tests[j, i] = executor.submit(
+                    landmarks[j]._test_landmarks, lmark_p, fs
+                )
+    # pick the first fulfilling directory walking up, as serially
+    results = []
+    for j, lmark in enumerate(landmarks):
+        limit = deadline
+        if lmark.deadline is not None:
+            limit = min(limit or float("inf"), began + lmark.deadline)
+        result = (None, None)
+        levels = candidates[j]
+        try:
+            for n, i in enumerate(levels):
+                timeout = None if limit is None else max(0, limit - monotonic())
+                matched = tests[j, i].result(timeout)
+                if matched:
+                    result = (matched, lmark.context)
+                    for i in levels[n + 1 :]:  # noqa
+                        tests[j, i].cancel()
+                    break
+        except concurrent.futures.TimeoutError:
+            for i in levels:
+                tests[j, i].cancel()
+            fs.complete = False
+            fs.abandoned.append(lmark)
+            print(
+                "contextual: [rule: {}] abandoned, exceeded deadline".format(lmark.src),
+                file=sys.stderr,
+            )
+        results.append(result)
+    return results
+
+
+def shortcut_table(index, fs=None, within=(), including=()):
+    """=> {shortcut or first shortcut segment: [landmark keys]}.
+
+    For /* and /** landmarks the keys are the subdirectories of their
+    prefix (listed through fs), else the trailing parts of the prefix,
+    as Landmark.match_shortcut can match them. Landmark keys are
+    tuples as for LandmarkIndex.landmark_at, covering the rules of
+    included files under their include prefixes (within) too.
+    """
+    if fs is None:
+        fs = FSCache()
+    if index.path is not None:
+        including += (os.path.realpath(index.path),)
+    table = {}
+    for i, lmark in enumerate(index.landmarks):
+        prefix_segs = lmark.prefix_segs
+        # as LandmarkIndex.candidates
+        if any(prefix_segs[: len(segs)] != segs for segs in within):
+            continue
+        if isinstance(lmark, Include):
+            if os.path.realpath(lmark.path) in including:
+                # reported by resolutions
+                continue
+            # the table depends on the included rules
+            fs.mtime(lmark.path)
+            try:
+                included = index.load_include(lmark.path)
+            except OSError:
+                continue
+            inc_table = shortcut_table(included, fs, within + (prefix_segs,), including)
+            for name, keys in inc_table.items():
+                table.setdefault(name, []).extend((i,) + key for key in keys)
+            continue
+        if lmark.wildcard_descendant:
+            prefix = os.path.join("/", "/".join(prefix_segs))
+            names = [name for name, is_dir in fs.listdir(prefix) if is_dir]
+        else:
+            names = ["/".join(prefix_segs[k:]) for k in range(len(prefix_segs))]
+        for name in names:
+            table.setdefault(name, []).append((i,))
+    return table
+
+
+class Include(object):
+    """Rules of another config file, all under prefix, taking the place
+    of the include line in rule order."""
+
+    def __init__(self, prefix, path):
+        self.prefix_segs = segs(prefix)
+        self.path = path
+
+
+def load_include(path):
+    """=> LandmarkIndex of the rules of config file path."""
+    with open(path) as f:
+        index = LandmarkIndex(parse(f, os.path.dirname(path)))
+    index.path = path
+    return index
+
+
+class LandmarkIndex(object):
+    """Segment trie over landmark prefixes, to find candidate rules."""
+
+    # config file the rules were parsed from, if known
+    path = None
+    # lines reporting the rules of it that did not parse
+    warnings = ()
+
+    def __init__(self, landmarks):
+        self.landmarks = landmarks
+        # included files are loaded only for start directories under
+        # their prefix, by this
+        self.load_include = load_include
+        # node: (children by segment, indexes of rules with this prefix)
+        self.root = ({}, [])
+        for i, lmark in enumerate(landmarks):
+            node = self.root
+            for seg in lmark.prefix_segs:
+                node = node[0].setdefault(seg, ({}, []))
+            node[1].append(i)
+
+    def landmark_at(self, key):
+        """=> landmark of a shortcut_table key, loading included files."""
+        lmark = self.landmarks[key[0]]
+        if len(key) == 1:
+            return lmark
+        return self.load_include(lmark.path).landmark_at(key[1:])
+
+    def candidates(self, p_segs, fs=None, scan_all=False, including=()):
+        """=> [(key, landmark)] in rule order with prefix an ancestor of p.
+
+        Keys are indexes, (index, key in included) tuples for the rules
+        of included files. With scan_all all rules (of included files
+        under p) are returned. including are the real paths of the files
+        including these rules, an include of one of them is skipped.
+        """
+        if scan_all:
+            found = range(len(self.landmarks))
+        else:
+            node = self.root
+            found = list(node[1])
+            for seg in p_segs:
+                node = node[0].get(seg)
+                if node is None:
+                    break
+                found.extend(node[1])
+            found.sort()
+        cands = []
+        chain = None
+        for i in found:
+            lmark = self.landmarks[i]
+            if not isinstance(lmark, Include):
+                cands.append((i, lmark))
+                continue
+            prefix_segs = lmark.prefix_segs
+            if p_segs[: len(prefix_segs)] != prefix_segs:
+                continue
+            if chain is None:
+                chain = including
+                if self.path is not None:
+                    chain += (os.path.realpath(self.path),)
+            if os.path.realpath(lmark.path) in chain:
+                if fs is not None:
+                    # keep reporting the error
+                    fs.complete = False
+                print(
+                    "contextual: [rule: {}] include cycle".format(lmark.src),
+                    file=sys.stderr,
+                )
+                continue
+            if fs is not None:
+                # resolutions depend on the included rules
+                fs.mtime(lmark.path)
+            try:
+                included = self.load_include(lmark.path)
+            except OSError as e:
+                if fs is not None:
+                    fs.complete = False
+                print("contextual: [rule: {}] {}".format(lmark.src, e), file=sys.stderr)
+                continue
+            inc_cands = included.candidates(p_segs, fs, scan_all, chain)
+            for key, inc_lmark in inc_cands:
+                # rules outside the prefix would depend on the start dirs
+                if inc_lmark.prefix_segs[: len(prefix_segs)] == prefix_segs:
+                    if type(key) is not tuple:
+                        key = (key,)
+                    cands.append(((i,) + key, inc_lmark))
+        return cands
+
+
+def _parse_deadline(parts):
+    """=> seconds popped from parts after within."""
+    value = parts.pop(0) if parts else ""
+    try:
+        return float(value)
+    except ValueError:
+        raise LandmarkError("within needs seconds, got {!r}".format(value))
+
+
+def _print_report(line):
+    print(line, file=sys.stderr)
+
+
+def parse(cfg_lines, cfg_dir=None, report=_print_report):
+    """Parse config lines into directory landmark to context definitions.
+
+    Relative include paths are taken relative to cfg_dir. Rules that
+    don't parse are skipped and reported by calling report with the
+    message line.
+    """
+    # imported here, resolutions served from caches don't need them
+    from functools import partial
+    import shlex
+
     landmarks = []
     for line in cfg_lines:
         line = line.strip()
         if not line or line.startswith("#"):
             continue
+        if line.startswith("include ") and ":=" not in line:
+            # include prefix path
+            include, prefix, path = shlex.split(line)
+            path = os.path.join(cfg_dir or "", os.path.expanduser(path))
+            include = Include(os.path.expanduser(prefix), os.path.abspath(path))
+            include.src = line
+            landmarks.append(include)
+            continue
         landmark_def, context = line.split(":=")
         parts = shlex.split(landmark_def)
         context = context.strip()
         wildcard_descendant = None
-        if parts[0] != "where":
+        if parts[0] not in ("where", "within", "capture"):
             prefix = os.path.expanduser(parts[0])
             parts.pop(0)
             if prefix.endswith("/*"):
@@ -205,24 +884,43 @@ def parse(cfg_lines):
                 wildcard_descendant = "rec"
         else:
             prefix = None
+        deadline = None
+        capture = False
+        try:
+            while parts and parts[0] in ("within", "capture"):
+                if parts.pop(0) == "within":
+                    # seconds the landmark probes of the rule may take
+                    deadline = _parse_deadline(parts)
+                else:
+                    capture = True
+        except LandmarkError as e:
+            report("contextual: [rule: {}] {}".format(line, e))
+            continue
         where = None
         if parts:
             assert parts[0] == "where"
             parts.pop(0)
             where = LandmarkClause()
             next_part = partial(next, iter(parts))
-            while True:
-                try:
-                    check_op = next_part()
-                except StopIteration:
-                    break
-                check = LANDMARK_CHECKS[check_op]
-                relative = next_part()
-                where.push_cond(check, relative)
+            try:
+                while True:
+                    try:
+                        check_op = next_part()
+                    except StopIteration:
+                        break
+                    check = LANDMARK_CHECKS[check_op]
+                    relative = next_part()
+                    where.push_cond(check, relative)
+            except LandmarkError as e:
+                # reported once here instead of at every match
+                report("contextual: [rule: {}] {}".format(line, e))
+                continue
         try:
-            lmark = Landmark(prefix, wildcard_descendant, where, context)
+            lmark = Landmark(
+                prefix, wildcard_descendant, where, context, deadline, capture
+            )
         except TooUnconstrained:
-            print("contextual: too unconstrained: {}".format(line), file=sys.stderr)
+            report("contextual: too unconstrained: {}".format(line))
             continue
         lmark.src = line
         landmarks.append(lmark)
@@ -0,0 +1,121 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import asyncio
+import threading
+import time
+
+import _contextual_async
+import ctxresolve
+import landmark
+
+
+@pytest.fixture(scope="function")
+def tree(request, tmpdir):
+    """=> index, start dirs under a tree with projects p1, p2"""
+    request.addfinalizer(lambda: tmpdir.remove(rec=1, ignore_errors=True))
+    root = tmpdir.join("root")
+    root.join("p1", "venv", "bin", "activate").ensure()
+    root.join("p1", ".git").ensure_dir()
+    root.join("p2", "sub", "deep").ensure_dir()
+    conf = u"""
+{0}/** where -f */bin/activate := source {{1}}
+{0}/* where -d .git := GIT={{ctx_dir}}
+{0}/* := export PROJ={{ctx_dir}}
+{0}/p2 := P2=1
+/ :=
+""".format(
+        root.strpath
+    )
+    index = landmark.LandmarkIndex(landmark.parse(conf.splitlines()))
+    dirs = [
+        root.join("p1", "venv", "bin").strpath,
+        root.join("p1").strpath,
+        root.join("p2", "sub", "deep").strpath,
+        root.join("p2", "sub").strpath,
+        root.strpath,
+    ]
+    return index, dirs
+
+
+def _trace_nothing(*a):
+    pass
+
+
+def test_same_as_infer_contexts(tree):
+    index, dirs = tree
+
+    async def resolve_all():
+        prober = _contextual_async.AsyncProber(limit=2)
+        return await asyncio.gather(
+            *[
+                _contextual_async.infer_contexts(
+                    index, [("PWD", d), ("getcwd", d)], _trace_nothing, prober
+                )
+                for d in dirs
+            ]
+        )
+
+    results = asyncio.run(resolve_all())
+    for d, context_pairs in zip(dirs, results):
+        locations = [("PWD", d), ("getcwd", d)]
+        expected = ctxresolve.infer_contexts(index, locations, _trace_nothing)
+        assert context_pairs == expected
+    assert results[0][0][1] == "source {1}"
+
+
+def test_dedupe_and_limit(tree, monkeypatch):
+    index, dirs = tree
+    lock = threading.Lock()
+    running = [0, 0]
+    tested = []
+    orig_test_landmarks = landmark.Landmark._test_landmarks
+
+    def slow_test_landmarks(self, p, fs=None):
+        with lock:
+            tested.append((self.src, p))
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        try:
+            return orig_test_landmarks(self, p, fs)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(landmark.Landmark, "_test_landmarks", slow_test_landmarks)
+    prober = _contextual_async.AsyncProber(limit=3)
+
+    async def resolve_siblings():
+        return await asyncio.gather(
+            *[
+                _contextual_async.infer_contexts(
+                    index, [("dir", d)], _trace_nothing, prober
+                )
+                for d in dirs[2:4]
+            ]
+        )
+
+    deep, sub = asyncio.run(resolve_siblings())
+    assert deep == sub
+    # the tests of the shared ancestors were made once
+    assert len(tested) == len(set(tested))
+    assert running[1] <= 3
+    assert prober.fs.steps["dirs"] == len(tested)
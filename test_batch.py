@@ -0,0 +1,99 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import json
+import os
+
+import _contextual_batch
+from _contextual import main
+
+
+@pytest.fixture(scope="function")
+def tree(request, monkeypatch, tmpdir):
+    """=> config, dirs under a tree with projects p1, p2, p3 -> p1"""
+    request.addfinalizer(lambda: tmpdir.remove(rec=1, ignore_errors=True))
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    root = tmpdir.join("root")
+    root.join("p1", "venv", "bin", "activate").ensure()
+    root.join("p1", "src", "pkg").ensure_dir()
+    root.join("p2", "sub").ensure_dir()
+    root.join("p3").mksymlinkto(root.join("p1"))
+    conf = u"""
+{0}/** where -f */bin/activate := source {{1}}
+{0}/* := export PROJ={{ctx_dir}}
+{1} := PROJ2=1
+""".format(
+        root.strpath, root.join("p2").strpath
+    )
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    dirs = [
+        root.join("p1", "src", "pkg"),
+        root.join("p1"),
+        root.join("p2", "sub"),
+        root.join("p3", "src"),
+        root,
+        root.join("missing"),
+    ]
+    return confp.strpath, [d.strpath for d in dirs]
+
+
+def single_run(conf, d, capsys):
+    """=> (exit code, context or None) of _contextual.py run from d."""
+    try:
+        main([conf, "cmd"], environ={"PWD": d}, cwd=os.path.realpath(d))
+    except SystemExit as e:
+        capsys.readouterr()
+        return e.code, None
+    out, err = capsys.readouterr()
+    return 0, out[:-1]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_same_as_single_runs(tree, capsys, jobs):
+    conf, dirs = tree
+    existing = dirs[:-1]
+    expected = {d: single_run(conf, d, capsys) for d in existing}
+    expected[dirs[-1]] = (1, None)
+    index = _contextual_batch.ctxcache.load_index(conf)
+    results = _contextual_batch.resolve_batch(index, iter(dirs), jobs)
+    got = {d: (code, context) for d, code, context in results}
+    assert got == expected
+    assert got[dirs[1]][0] == 0
+
+
+def test_main(tree, tmpdir, capsys):
+    conf, dirs = tree
+    dirs_file = tmpdir.join("dirs")
+    dirs_file.write("\n".join(dirs[:3]) + "\n")
+    with pytest.raises(SystemExit) as exit_info:
+        _contextual_batch.main([conf, dirs_file.strpath])
+    assert exit_info.value.code == 0
+    out, err = capsys.readouterr()
+    results = [json.loads(line) for line in out.splitlines()]
+    assert [r["dir"] for r in results] == dirs[:3]
+    p2 = os.path.dirname(dirs[2])
+    context = "PROJ2=1;export PROJ={}".format(p2)
+    assert results[2] == {"dir": dirs[2], "exit": 0, "context": context}
+
+    with pytest.raises(SystemExit) as exit_info:
+        _contextual_batch.main([conf, "--format", "tsv", dirs_file.strpath])
+    out, err = capsys.readouterr()
+    assert out.splitlines()[2].split("\t") == [dirs[2], "0", context]
@@ -0,0 +1,49 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+
+from bench_landmark import main, make_config, make_tree
+from landmark import parse
+
+
+def test_make_tree_and_config(tmpdir):
+    leaves = make_tree(tmpdir.strpath, 2, 2, 1, 2)
+    assert len(leaves) == 4
+    assert tmpdir.join("d0", "d1", "e0").check(file=1)
+    assert tmpdir.join("d1", "venv", "bin", "activate").check(file=1)
+    lines = make_config(tmpdir.strpath, 8, 2)
+    lmarks = parse(lines)
+    assert len(lmarks) == 9
+    assert set(lm.wildcard_descendant for lm in lmarks) == {None, "one", "rec"}
+
+
+def test_bench_smoke(tmpdir, capsys):
+    out = tmpdir.join("bench.json")
+    args = "--depth 2 --fanout 2 --rules 4 40 --starts 2 --repeat 1 --output"
+    main(args.split() + [out.strpath])
+    results = [json.loads(line) for line in out.readlines()]
+    assert [r["rules"] for r in results] == [5, 41]
+    for r in results:
+        assert r["resolutions"] == 2
+        assert r["latency_s"]["min"] <= r["latency_s"]["max"]
+        calls = set(r["fs_calls_per_resolution"])
+        assert calls == {"stat", "lstat", "access", "scandir", "glob"}
+    assert capsys.readouterr()[0].splitlines() == [
+        line.rstrip("\n") for line in out.readlines()
+    ]
@@ -0,0 +1,185 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import os
+
+import ctxcache
+import landmark
+
+
+@pytest.fixture(scope="function")
+def conf(monkeypatch, tmpdir):
+    """=> config path with one rule, caches isolated under tmpdir"""
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(u"/home/* where -d .git := PROJ={ctx_dir}\n", "ascii")
+    return confp
+
+
+def test_load_landmarks_cached(conf, monkeypatch):
+    lmarks = ctxcache.load_landmarks(conf.strpath)
+    assert [lm.src for lm in lmarks] == ["/home/* where -d .git := PROJ={ctx_dir}"]
+
+    def no_parse(lines):
+        raise AssertionError("parse should not be called")
+
+    monkeypatch.setattr(landmark, "parse", no_parse)
+    lmarks = ctxcache.load_landmarks(conf.strpath)
+    assert lmarks[0].prefix_segs == ["home"]
+    assert lmarks[0].where.conds[0].relative == ".git"
+    assert dict(ctxcache.rules_cache_info(conf.strpath))["state"] == "fresh"
+
+
+def test_load_landmarks_stale(conf):
+    ctxcache.load_landmarks(conf.strpath)
+    conf.write_text(u"/ := A\n/home := B\n", "ascii")
+    assert dict(ctxcache.rules_cache_info(conf.strpath))["state"] == "stale"
+    lmarks = ctxcache.load_landmarks(conf.strpath)
+    assert [lm.context for lm in lmarks] == ["A", "B"]
+    assert dict(ctxcache.rules_cache_info(conf.strpath))["state"] == "fresh"
+
+
+
+def test_load_landmarks_warnings(conf, capsys):
+    conf.write_text(u"/home/** := A\n/** := B\n/ := C\n", "ascii")
+    warnings = [
+        "contextual: too unconstrained: /home/** := A",
+        "contextual: too unconstrained: /** := B",
+    ]
+    for state in ["missing", "fresh"]:
+        assert dict(ctxcache.rules_cache_info(conf.strpath))["state"] == state
+        lmarks = ctxcache.load_landmarks(conf.strpath)
+        assert [lm.context for lm in lmarks] == ["C"]
+        # reported from the cache as well
+        assert capsys.readouterr()[1].splitlines() == warnings
+
+
+def test_load_landmarks_corrupt_cache(conf):
+    ctxcache.load_landmarks(conf.strpath)
+    with open(ctxcache.cache_path(conf.strpath, "rules"), "wb") as f:
+        f.write(b"garbage")
+    assert dict(ctxcache.rules_cache_info(conf.strpath))["state"] == "missing"
+    lmarks = ctxcache.load_landmarks(conf.strpath)
+    assert len(lmarks) == 1
+
+
+def _fs_probing(p):
+    fs = landmark.FSCache()
+    fs.stat(p)
+    return fs
+
+
+def test_contexts_table_shared(conf, tmpdir):
+    d = tmpdir.join("d").ensure_dir().strpath
+    locations = [("PWD", d), ("getcwd", d)]
+    assert ctxcache.lookup_context(conf.strpath, locations)[:2] == (
+        "miss",
+        "no entries",
+    )
+    assert ctxcache.store_context(conf.strpath, locations, "A=1", _fs_probing(d))
+    # as seen by another process, mapping the table anew
+    ctxcache._mapped.clear()
+    assert ctxcache.lookup_context(conf.strpath, locations) == ("hit", None, "A=1")
+    # the mapping sees stores made after it
+    assert ctxcache.store_context(conf.strpath, locations, "A=2", _fs_probing(d))
+    assert ctxcache.lookup_context(conf.strpath, locations) == ("hit", None, "A=2")
+    assert dict(ctxcache.contexts_cache_info(conf.strpath))["contexts"] == 1
+    tmpdir.join("d").remove()
+    status, detail, context = ctxcache.lookup_context(conf.strpath, locations)
+    assert status == "invalidated"
+
+
+def test_contexts_table_torn_slot(conf, tmpdir):
+    d = tmpdir.strpath
+    locations = [("PWD", d)]
+    ctxcache.store_context(conf.strpath, locations, "A=1", _fs_probing(d))
+    key_hash = ctxcache._key_hash(tuple(locations))
+    table_p = ctxcache.cache_path(conf.strpath, "contexts")
+    with open(table_p, "r+b") as f:
+        for i in ctxcache._bucket(key_hash):
+            off = ctxcache._slot_offset(i)
+            f.seek(off)
+            seq = ctxcache._SLOT_HEADER.unpack(f.read(ctxcache._SLOT_HEADER.size))[0]
+            if seq:
+                # a writer died halfway
+                f.seek(off)
+                f.write(ctxcache.struct.pack("<I", seq + 1))
+    assert ctxcache.lookup_context(conf.strpath, locations)[:2] == ("miss", "no entry")
+    assert ctxcache.store_context(conf.strpath, locations, "A=2", _fs_probing(d))
+    assert ctxcache.lookup_context(conf.strpath, locations) == ("hit", None, "A=2")
+
+
+
+def test_contexts_table_spill(conf, tmpdir, monkeypatch):
+    d = tmpdir.strpath
+    locations = [("PWD", d)]
+    big_fs = _fs_probing(d)
+    for i in range(500):
+        big_fs.stat(os.path.join(d, os.urandom(8).hex()))
+    assert ctxcache.store_context(conf.strpath, locations, "A=1", big_fs)
+    spill_d = ctxcache.cache_path(conf.strpath, "spill")
+    assert len(os.listdir(spill_d)) == 1
+    ctxcache._mapped.clear()
+    assert ctxcache.lookup_context(conf.strpath, locations) == ("hit", None, "A=1")
+    # a replaced entry takes its spill file along
+    assert ctxcache.store_context(conf.strpath, locations, "A=2", _fs_probing(d))
+    assert os.listdir(spill_d) == []
+    assert ctxcache.lookup_context(conf.strpath, locations) == ("hit", None, "A=2")
+    monkeypatch.setattr(ctxcache, "CONTEXTS_SPILL_MAX", 1024)
+    assert not ctxcache.store_context(conf.strpath, locations, "A=3", big_fs)
+    assert ctxcache.lookup_context(conf.strpath, locations) == (
+        "miss",
+        "too large",
+        None,
+    )
+
+
+def test_contexts_table_concurrent_writers(conf, tmpdir):
+    multiprocessing = pytest.importorskip("multiprocessing")
+    # one more key than fit in a bucket
+    dirs = []
+    i = 0
+    while len(dirs) <= ctxcache.CONTEXTS_WAYS:
+        d = tmpdir.join("d{}".format(i)).ensure_dir().strpath
+        i += 1
+        if ctxcache._key_hash((("PWD", d),)) % ctxcache.CONTEXTS_BUCKETS == 0:
+            dirs.append(d)
+    last = dirs.pop()
+
+    def store(d):
+        for n in range(20):
+            ctxcache.store_context(conf.strpath, [("PWD", d)], d, _fs_probing(d))
+
+    procs = [
+        multiprocessing.get_context("fork").Process(target=store, args=(d,))
+        for d in dirs
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+    for d in dirs:
+        assert ctxcache.lookup_context(conf.strpath, [("PWD", d)]) == ("hit", None, d)
+    # a full bucket drops its least recently stored entry
+    ctxcache.store_context(conf.strpath, [("PWD", last)], last, _fs_probing(last))
+    hits = [ctxcache.lookup_context(conf.strpath, [("PWD", d)])[0] for d in dirs]
+    assert hits.count("hit") == ctxcache.CONTEXTS_WAYS - 1
+    assert ctxcache.lookup_context(conf.strpath, [("PWD", last)])[0] == "hit"
@@ -0,0 +1,115 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import os
+import subprocess
+import sys
+import threading
+
+from _contextual import main
+from _contextual_client import request
+from _contextual_daemon import ResolverServer
+
+
+@pytest.fixture(scope="function")
+def conf_and_projs(request, monkeypatch, tmpdir):
+    """=> config, proj1/a, proj2/b"""
+    request.addfinalizer(lambda: tmpdir.remove(rec=1, ignore_errors=True))
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    a = tmpdir.join("proj1", "a").ensure_dir()
+    b = tmpdir.join("proj2", "b").ensure_dir()
+    a.dirpath().join(".git").ensure_dir()
+    conf = u"""
+{}/* where -d .git := PROJ={{ctx_dir}}
+{} := PROJ={{2}}
+""".format(
+        tmpdir.strpath, b.strpath
+    )
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    return confp, a, b
+
+
+@pytest.fixture(scope="function")
+def server(tmpdir):
+    """=> socket path of a running resolver daemon"""
+    sock_path = tmpdir.join("s.sock").strpath
+    server = ResolverServer(sock_path)
+    t = threading.Thread(target=server.serve_forever, args=(0.05,))
+    t.start()
+    yield sock_path
+    server.shutdown()
+    server.server_close()
+    t.join()
+
+
+def direct(args, cwd, capsys):
+    code = 0
+    try:
+        main(args, environ={"PWD": cwd}, cwd=cwd)
+    except SystemExit as e:
+        code = e.code
+    out, err = capsys.readouterr()
+    return code, out, err
+
+
+@pytest.mark.parametrize(
+    "where, extra",
+    [("a", []), ("a", [":trace"]), ("b", []), ("b", [":trace"]), ("", [])],
+)
+def test_same_as_direct(conf_and_projs, server, capsys, where, extra):
+    confp, a, b = conf_and_projs
+    cwd = {"a": a, "b": b, "": confp.dirpath()}[where].strpath
+    args = [confp.strpath, "cmd"] + extra
+    direct(args, cwd, capsys)
+    # with warm caches, as :trace reports their state
+    expected = direct(args, cwd, capsys)
+    assert request(server, args, cwd, cwd) == expected
+    assert request(server, args, cwd, cwd) == expected
+
+
+def test_relative_config(conf_and_projs, server, capsys):
+    confp, a, b = conf_and_projs
+    cwd = confp.dirpath().strpath
+    code, out, err = request(server, ["ctx.conf", "proj1/a/cmd"], cwd, cwd)
+    assert (code, out) == (0, "PROJ={}\n".format(a.dirpath().strpath))
+
+
+def test_foreign_socket(conf_and_projs, server, monkeypatch):
+    confp, a, b = conf_and_projs
+    monkeypatch.setattr(os, "getuid", lambda: os.stat(server).st_uid + 1)
+    with pytest.raises(PermissionError):
+        request(server, [confp.strpath, "cmd"], a.strpath, a.strpath)
+
+
+def test_client_fallback(conf_and_projs, tmpdir):
+    confp, a, b = conf_and_projs
+    env = dict(os.environ, CONTEXTUAL_SOCKET=tmpdir.join("none.sock").strpath)
+    env["PWD"] = a.strpath
+    client = os.path.join(os.path.dirname(__file__), "_contextual_client.py")
+    res = subprocess.run(
+        [sys.executable, client, confp.strpath, "cmd"],
+        cwd=a.strpath,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    assert res.returncode == 0
+    assert res.stdout == "PROJ={}\n".format(a.dirpath().strpath).encode("ascii")
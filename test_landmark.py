@@ -18,14 +18,25 @@
 #
 import pytest
 
+import glob
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import landmark
 from landmark import (
+    changed_dependency,
     check_is_non_empty,
     check_is_executable,
+    FSCache,
     Landmark,
     LandmarkClause,
+    LandmarkCond,
+    LandmarkIndex,
+    match_all,
     parse,
+    register_check,
     segs,
     Succeed,
 )
@@ -174,6 +185,151 @@ def test_landmark_match_shortcut_no_match(home_and_here, hopeless_where):
     assert res == (None, None)
 
 
+
+def test_landmark_index_include_cycle(tmpdir, capsys):
+    self_conf = tmpdir.join("self.conf")
+    self_conf.write("/home := S\ninclude /home self.conf\n")
+    index = landmark.load_include(self_conf.strpath)
+    fs = FSCache()
+    cands = index.candidates(segs("/home/user0"), fs)
+    assert [lm.context for i, lm in cands] == ["S"]
+    assert not fs.complete
+    err = capsys.readouterr()[1]
+    assert err == "contextual: [rule: include /home self.conf] include cycle\n"
+    # through another file, with the including config unknown
+    tmpdir.join("other.conf").write("include /home self.conf\n")
+    index = LandmarkIndex(parse(["include /home other.conf"], tmpdir.strpath))
+    cands = index.candidates(segs("/home/user0"))
+    assert [lm.context for i, lm in cands] == ["S"]
+    assert "include cycle" in capsys.readouterr()[1]
+
+
+def test_match_all(home_and_here):
+    home, p, s = home_and_here
+    lmarks = parse(
+        [
+            "{}/** where -d * -d {{1}}/z := A".format(os.path.dirname(home)),
+            "{}/* := B".format(home),
+            "{}/** where -e .bashrc := C".format(home),
+            "{} := D".format(p),
+            "{}/* := E".format(p),
+            "/nowhere := F",
+            "where -d x := G",
+            "where -f .bashrc -d nope := H",
+        ]
+    )
+    fs = FSCache()
+    res = match_all(lmarks, p, s, fs)
+    serial_fs = FSCache()
+    assert res == [lm.match(p, s, serial_fs) for lm in lmarks]
+    contexts = [context for matched, context in res]
+    assert contexts == ["A", "B", "C", "D", None, None, "G", None]
+    # same candidates tested, just in walk order
+    assert fs.steps == serial_fs.steps
+    assert fs.counts == serial_fs.counts
+
+    with ThreadPoolExecutor(4) as executor:
+        assert match_all(lmarks, p, s, FSCache(), executor) == res
+
+
+def test_match_all_concurrently(home_and_here, monkeypatch):
+    home, p, s = home_and_here
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+    lock = threading.Lock()
+    active = [0, 0]
+
+    @register_check("-slow")
+    def check_slow(q):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return os.path.isfile(q)
+
+    lmarks = parse(
+        [
+            "{}/** where -slow .bashrc := A".format(home),
+            "{}/** where -slow x := B".format(home),
+            "{}/** where -slow y/z := C".format(home),
+        ]
+    )
+    with ThreadPoolExecutor(4) as executor:
+        res = match_all(lmarks, p, s, FSCache(), executor)
+    assert res == [
+        ([home, os.path.join(home, ".bashrc")], "A"),
+        (None, None),
+        (None, None),
+    ]
+    assert active[1] > 1
+
+
+def test_match_all_deadline(home_and_here, monkeypatch, capsys):
+    home, p, s = home_and_here
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+    stalled = threading.Event()
+
+    @register_check("-stalled")
+    def check_stalled(q):
+        stalled.wait(5)
+        return True
+
+    lmarks = parse(
+        [
+            "{}/** within 0.05 where -stalled .bashrc := A".format(home),
+            "{}/** where -f .bashrc := B".format(home),
+            "{}/** where -stalled x := C".format(home),
+        ]
+    )
+    fs = FSCache()
+    with ThreadPoolExecutor(4) as executor:
+        start = time.monotonic()
+        res = match_all(lmarks, p, s, fs, executor, start + 0.1)
+        elapsed = time.monotonic() - start
+        stalled.set()
+    assert res == [
+        (None, None),
+        ([home, os.path.join(home, ".bashrc")], "B"),
+        (None, None),
+    ]
+    assert elapsed < 1
+    assert fs.abandoned == [lmarks[0], lmarks[2]]
+    assert not fs.complete
+    err = capsys.readouterr()[1]
+    assert err.splitlines() == [
+        "contextual: [rule: {}] abandoned, exceeded deadline".format(lmarks[0].src),
+        "contextual: [rule: {}] abandoned, exceeded deadline".format(lmarks[2].src),
+    ]
+
+
+
+def test_match_all_deadline_healthy(home_and_here, monkeypatch, capsys):
+    home, p, s = home_and_here
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+
+    @register_check("-slowish")
+    def check_slowish(q):
+        time.sleep(0.01)
+        return os.path.isfile(q)
+
+    lmarks = parse(
+        [
+            "{}/** within 2 where -slowish .bashrc := A".format(home),
+            "{}/** within 5 where -f .bashrc -d x := B".format(home),
+        ]
+    )
+    fs = FSCache()
+    with ThreadPoolExecutor(4) as executor:
+        res = match_all(lmarks, p, s, fs, executor)
+    assert res == [
+        ([home, os.path.join(home, ".bashrc")], "A"),
+        ([home, os.path.join(home, ".bashrc"), os.path.join(home, "x")], "B"),
+    ]
+    assert fs.abandoned == []
+    assert capsys.readouterr()[1] == ""
+
+
 def test_parse():
     lm = parse(["#test", "", "where -s .bashrc := zzz"])[0]
     assert lm.prefix_segs == []
@@ -225,15 +381,306 @@ def test_parse():
     lm = parse(["#test", "", "/home/** := zzz"])
     assert len(lm) == 0
 
+    lm = parse(["/home/** within 0.5 where -d .git := zzz"])[0]
+    assert lm.prefix_segs == ["home"]
+    assert lm.deadline == 0.5
+    assert lm.where.conds[0].relative == ".git"
+
+    lm = parse(["within 2 where -d .git := zzz"])[0]
+    assert lm.prefix_segs == []
+    assert lm.deadline == 2.0
+    assert not lm.capture
+
+    lm = parse(["/home/* within 2 capture := source {0}/activate"])[0]
+    assert lm.prefix_segs == ["home"]
+    assert lm.deadline == 2.0
+    assert lm.capture
+
+
+def test_landmark_index():
+    lmarks = parse(
+        [
+            "/home/* := A",
+            "/ := B",
+            "/home/user0/proj := C",
+            "/home/user1 := D",
+            "where -e .git := E",
+            "/home/user0/** where -e .git := F",
+        ]
+    )
+    index = LandmarkIndex(lmarks)
+    cands = index.candidates(segs("/home/user0/proj/sub"))
+    assert [lm.context for i, lm in cands] == ["A", "B", "C", "E", "F"]
+    assert [i for i, lm in cands] == [0, 1, 2, 4, 5]
+    cands = index.candidates(segs("/home/user1"))
+    assert [lm.context for i, lm in cands] == ["A", "B", "D", "E"]
+    cands = index.candidates(segs("/"))
+    assert [lm.context for i, lm in cands] == ["B", "E"]
+    cands = index.candidates(segs("/tmp/home/user0"))
+    assert [lm.context for i, lm in cands] == ["B", "E"]
+
+
+def test_landmark_index_include(tmpdir):
+    tmpdir.join("user0.conf").write(
+        "/home/user0/** where -e .git := I0\n"
+        "/home/user1 := OUTSIDE\n"
+        "include /home/user0/proj sub/proj.conf\n"
+    )
+    tmpdir.join("sub", "proj.conf").ensure().write("/home/user0/proj := P\n")
+    lmarks = parse(
+        [
+            "/home/* := A",
+            "include /home/user0 user0.conf",
+            "include /home/user1 missing.conf",
+            "/ := B",
+        ],
+        tmpdir.strpath,
+    )
+    assert lmarks[1].path == tmpdir.join("user0.conf").strpath
+    index = LandmarkIndex(lmarks)
+    loaded = []
+
+    def load_include(path):
+        loaded.append(os.path.relpath(path, tmpdir.strpath))
+        return landmark.load_include(path)
+
+    index.load_include = load_include
+    fs = FSCache()
+    cands = index.candidates(segs("/home/user0/proj/sub"), fs)
+    assert [lm.context for i, lm in cands] == ["A", "I0", "P", "B"]
+    assert [i for i, lm in cands] == [0, (1, 0), (1, 2, 0), 3]
+    assert loaded == ["user0.conf"]
+    assert ("mtime", lmarks[1].path) in [dep[:2] for dep in fs.dependencies()]
+    # never loaded for start dirs elsewhere
+    del loaded[:]
+    cands = index.candidates(segs("/home/user2"))
+    assert [lm.context for i, lm in cands] == ["A", "B"]
+    cands = index.candidates(segs("/"), scan_all=True)
+    assert [lm.context for i, lm in cands] == ["A", "B"]
+    assert loaded == []
+
+
+def test_fs_cache_stats_once(home_and_here, monkeypatch):
+    home, p, s = home_and_here
+    hit = os.path.join(home, ".bashrc")
+    lmarks = parse(
+        [
+            "{}/** where -f .bashrc := A".format(home),
+            "{}/** where -s .bashrc := B".format(home),
+            "where -e .bashrc -x {1} := C",
+            "where -d .bashrc := D",
+        ]
+    )
+    stat_calls = []
+    real_stat = os.stat
+
+    def counting_stat(q, *args, **kwds):
+        stat_calls.append(q)
+        return real_stat(q, *args, **kwds)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    fs = FSCache()
+    res = [lm.match(p, s, fs) for lm in lmarks]
+    monkeypatch.undo()
+    assert res == [
+        ([home, hit], "A"),
+        ([home, hit], "B"),
+        ([home, hit, hit], "C"),
+        (None, None),
+    ]
+    assert stat_calls
+    assert len(stat_calls) == len(set(stat_calls))
+
+
+def test_fs_cache_glob(home_and_here):
+    home, p, s = home_and_here
+    fs = FSCache()
+    for rel in ["*", ".*", "*/z", "?/*", "y/", "*/", ".bashrc", "nope", "[xy]/z*"]:
+        pattern = os.path.join(home, rel)
+        assert sorted(fs.glob(pattern)) == sorted(glob.glob(pattern))
+
+
+def test_fs_cache_dependencies(home_and_here):
+    home, p, s = home_and_here
+    fs = FSCache()
+    assert not fs.glob(os.path.join(home, ".git"))
+    deps = fs.dependencies()
+    assert changed_dependency(deps) is None
+    os.mkdir(os.path.join(home, ".git"))
+    assert changed_dependency(deps) == ("stat", os.path.join(home, ".git"), None)
+    fs = FSCache()
+    assert fs.glob(os.path.join(home, "*/z"))
+    # served by the listing of home
+    assert not fs.glob(os.path.join(home, ".hg"))
+    deps = fs.dependencies()
+    assert changed_dependency(deps) is None
+    os.mkdir(os.path.join(home, "w"))
+    assert changed_dependency(deps)[:2] == ("listdir", home)
+
+
+def test_fs_cache_snapshot(home_and_here, monkeypatch):
+    home, p, s = home_and_here
+    os.symlink(os.path.join(home, "x"), os.path.join(home, "lx"))
+    lmarks = parse(
+        [
+            "{}/** where -d * -e {{1}}/nope := A".format(home),
+            "{}/** where -f .* -d x := B".format(home),
+            "{}/** where -d l* := C".format(home),
+        ]
+    )
+    stat_calls = []
+    real_stat = os.stat
+
+    def counting_stat(q, *args, **kwds):
+        stat_calls.append(q)
+        return real_stat(q, *args, **kwds)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    fs = FSCache()
+    res = [lm.match(p, s, fs) for lm in lmarks]
+    monkeypatch.undo()
+    lx = os.path.join(home, "lx")
+    assert res == [
+        (None, None),
+        ([home, os.path.join(home, ".bashrc"), os.path.join(home, "x")], "B"),
+        ([home, lx], "C"),
+    ]
+    # entry types come from the listings, only symlinks are followed
+    assert lx in stat_calls
+    assert not set(stat_calls) & {
+        os.path.join(home, name) for name in [".bashrc", "x", "y"]
+    }
+    assert changed_dependency(fs.dependencies()) is None
+    os.unlink(os.path.join(home, ".bashrc"))
+    assert changed_dependency(fs.dependencies())[:2] == ("listdir", home)
+
+    # x/ and x//marker are not spelled as listing entries, they are stat-ed
+    os.unlink(lx)
+    for name in ["a.cfg", "marker"]:
+        open(os.path.join(home, "x", name), "w").close()
+    lm = parse(["{}/** where -f x/*.cfg -d */ -f {{2}}/marker := D".format(home)])[0]
+    x = os.path.join(home, "x")
+    assert lm.match(p, s, FSCache()) == (
+        [home, os.path.join(x, "a.cfg"), x + "/", x + "//marker"],
+        "D",
+    )
+
+
+def test_fs_cache_lists_probed_dir(home_and_here):
+    home, p, s = home_and_here
+    fs = FSCache()
+    for i in range(landmark.LIST_AFTER_PROBES):
+        assert not fs.lexists(os.path.join(home, ".mark{}".format(i)))
+    assert fs.counts["scandir"] == 0
+    stats = fs.counts["stat"]
+    assert not fs.lexists(os.path.join(home, ".other"))
+    assert fs.check(os.path.isfile, os.path.join(home, ".bashrc"))
+    assert not fs.check(os.path.exists, os.path.join(home, ".more"))
+    assert fs.counts["scandir"] == 1
+    # just the one of home for its listing
+    assert fs.counts["stat"] == stats + 1
+
+
+def test_fs_cache_memoized_check(home_and_here, monkeypatch):
+    home, p, s = home_and_here
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+    monkeypatch.setattr(landmark, "MEMOIZED_CHECKS", set(landmark.MEMOIZED_CHECKS))
+    checked = []
+
+    @register_check("-r", memoize=True)
+    def check_readable(q):
+        checked.append(q)
+        return os.access(q, os.R_OK)
+
+    lmarks = parse(["where -r .bashrc := A", "where -r .bashrc -d nope := B"])
+    fs = FSCache()
+    assert lmarks[0].match(p, s, fs) == ([home, os.path.join(home, ".bashrc")], "A")
+    assert lmarks[1].match(p, s, fs) == (None, None)
+    assert checked == [os.path.join(home, ".bashrc")]
+
 
 def test_placeholder_error(capsys):
-    rule1 = "where -e {2}/x := ctx"
-    lm = parse([rule1])[0]
+    rules = [
+        "where -e {2}/x := ctx",
+        "where -e {foo} := ctx",
+        "where -e {1:>3} := ctx",
+        "where -d * -e {}/{1} := ctx",
+        "where -d * -e {1}/{ctx_dir}/{ctxdir}/x := ok",
+        "where -d * -e {}/{}/x := ok",
+    ]
+    lmarks = parse(rules)
+    # reported when parsing
+    assert [lm.src for lm in lmarks] == rules[4:]
+    out, err = capsys.readouterr()
+    assert err.splitlines() == [
+        "contextual: [rule: {}] {!r} has unbound/unknown placeholder".format(
+            rule, relative
+        )
+        for rule, relative in zip(rules, ["{2}/x", "{foo}", "{1:>3}", "{}/{1}"])
+    ]
+    # numbered in order as by str.format
+    assert lmarks[1].where.conds[1].parts == [0, "/", 1, "/x"]
+
+    where = LandmarkClause()
+    where.conds.append(LandmarkCond(os.path.exists, "{2}/x"))
+    lm = Landmark(None, None, where, "ctx")
+    lm.src = "where -e {2}/x := ctx"
     res = lm.match("/", segs("/"))
     assert res == (None, None)
     assert capsys.readouterr() == (
         "",
         "contextual: [rule: {}] {!r} has unbound/unknown placeholder\n".format(
-            rule1, "{2}/x"
+            lm.src, "{2}/x"
         ),
     )
+
+
+
+def test_within_error(capsys):
+    rules = [
+        "/a within soon where -d x := ctx",
+        "/a within := ctx",
+        "/a within 0.5 where -d x := ok",
+    ]
+    lmarks = parse(rules)
+    assert [lm.src for lm in lmarks] == rules[2:]
+    assert lmarks[0].deadline == 0.5
+    out, err = capsys.readouterr()
+    assert err.splitlines() == [
+        "contextual: [rule: {}] within needs seconds, got 'soon'".format(rules[0]),
+        "contextual: [rule: {}] within needs seconds, got ''".format(rules[1]),
+    ]
+
+
+def test_cond_plans(home_and_here, monkeypatch):
+    home, p, s = home_and_here
+    lmarks = parse(
+        [
+            "where -f .bashrc := A",
+            "where -d x -d {1}/ -e {ctx_dir}/y/z := B",
+            "where -d * -d {1}/z := C",
+        ]
+    )
+    conds = [cond for lm in lmarks for cond in lm.where.conds]
+    assert [cond.single for cond in conds] == [True, True, False, True, False, True]
+    assert conds[0].literal == ".bashrc"
+    assert conds[2].parts == [1, "/"]
+    assert conds[3].parts == [0, "/y/z"]
+
+    def no_glob(self, pattern, dironly=False):
+        raise AssertionError("globbed {}".format(pattern))
+
+    fs = FSCache()
+    monkeypatch.setattr(FSCache, "glob", no_glob)
+    assert lmarks[0].match(p, s, fs) == ([home, os.path.join(home, ".bashrc")], "A")
+    assert fs.steps["globs"] == 0
+    monkeypatch.undo()
+    x = os.path.join(home, "x")
+    assert lmarks[1].match(p, s, fs) == (
+        [home, x, x + "/", os.path.join(home, "y/z")],
+        "B",
+    )
+    assert lmarks[2].match(p, s, fs)[0][1:] == [
+        os.path.join(home, "y"),
+        os.path.join(home, "y/z"),
+    ]
@@ -0,0 +1,150 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import _contextual_lint
+import landmark
+
+
+def parse(conf):
+    return landmark.parse(conf.strip().splitlines())
+
+
+def test_rule_cost():
+    lmarks = parse(
+        u"""
+/home/* where -d .git := A=1
+/** where -f */bin/activate := source {1}
+/src/** where -d */* -f {1}/*/x := B=1
+/work := C=1
+"""
+    )
+    costs = [_contextual_lint.rule_cost(lm, depth=6, fanout=10) for lm in lmarks]
+    summary = [(c.walk, c.probes, c.fanout, c.backtrack, c.cost) for c in costs]
+    assert summary == [
+        (1, 1, 1, 1, 1),
+        # walks up to / from 6 deep, lists each, checks all the entries
+        (7, 11, 10, 1, 77),
+        # */* lists / and its 10 entries, yielding 100 candidates the
+        # second condition is evaluated for
+        (6, 111 + 100 * 11, 100, 100, 6 * 1211),
+        (1, 0, 1, 1, 0),
+    ]
+
+
+def test_never_matches():
+    lmarks = parse(
+        u"""
+/home/*/src := A=1
+/home/x where -f build/ := B=1
+/home/y where -d .git/ -f .git := C=1
+/home/z where -d build/ -f .git := D=1
+/home/[w]/src? := E=1
+"""
+    )
+    reasons = [_contextual_lint.never_matches(lm) for lm in lmarks]
+    assert reasons == [
+        "prefix segment '*' is not a wildcard",
+        "'build/' matches only directories, never files",
+        "'.git' is checked to be both a directory and a file",
+        None,
+        None,
+    ]
+
+
+def test_shadowed():
+    lmarks = parse(
+        u"""
+/home/* where -d .git := export PROJ={ctx_dir}
+/home/x where -d .git -f setup.py := export PROJ=1
+/home/y := export PROJ=1
+/home/z where -d .git := export OTHER=1; PROJ=1
+/** where -f */bin/activate := source {1}
+/home/** where -f */bin/activate := source {1}
+/home/** where -f */bin/activate := source {1}; X=1
+/opt/a := export X=1
+/opt/a/b := export X=2
+/opt/a/** where -d .git := export X=3
+/srv/* := export Y=1
+/srv/* where -d .git := export Y=2
+/srv/a/b := export Y=3
+/srv/** where -d .git := export Y=4
+"""
+    )
+    costs, issues = _contextual_lint.lint(lmarks)
+    assert issues == [
+        (lmarks[1].src, "shadowed by earlier rule: " + lmarks[0].src),
+        (lmarks[5].src, "shadowed by earlier rule: " + lmarks[4].src),
+        (lmarks[8].src, "shadowed by earlier rule: " + lmarks[7].src),
+        (lmarks[9].src, "shadowed by earlier rule: " + lmarks[7].src),
+        (lmarks[11].src, "shadowed by earlier rule: " + lmarks[10].src),
+        (lmarks[12].src, "shadowed by earlier rule: " + lmarks[10].src),
+    ]
+
+
+def test_include(tmpdir):
+    sub = tmpdir.join("sub.conf")
+    sub.write_text(u"/opt/a/** where -d .git := A=1\n/opt := B=1\n", "ascii")
+    lmarks = landmark.parse(["include /opt/a sub.conf"], tmpdir.strpath)
+    costs, issues = _contextual_lint.lint(lmarks, depth=5)
+    assert [(c.lmark.src, c.walk) for c in costs] == [
+        ("/opt/a/** where -d .git := A=1", 4)
+    ]
+    assert issues == [("/opt := B=1", "outside the prefix of its include, never used")]
+    sub.remove()
+    costs, issues = _contextual_lint.lint(lmarks)
+    assert costs == [] and len(issues) == 1
+
+
+
+def test_include_cycle(tmpdir, capsys):
+    confp = tmpdir.join("self.conf")
+    confp.write_text(u"/home := S=1\ninclude /home self.conf\n", "ascii")
+    with pytest.raises(SystemExit) as exit_info:
+        _contextual_lint.main([confp.strpath])
+    assert exit_info.value.code == 1
+    out, err = capsys.readouterr()
+    assert out.splitlines()[-1] == (
+        "contextual: [rule: include /home self.conf] include cycle"
+    )
+
+
+def test_main(tmpdir, capsys):
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(
+        u"""
+/home/* where -d .git := A=1
+/** where -d */* -d {1}/*/.git := B=1
+""",
+        "ascii",
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        _contextual_lint.main([confp.strpath])
+    assert exit_info.value.code == 1
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0].split() == ["cost", "walk", "fan-out", "backtrack", "rule"]
+    # most expensive first
+    assert lines[1].endswith("/** where -d */* -d {1}/*/.git := B=1")
+    assert lines[2].split()[:4] == ["1", "1", "1", "1"]
+    assert "] expensive, up to " in lines[3]
+
+    with pytest.raises(SystemExit) as exit_info:
+        _contextual_lint.main([confp.strpath, "--max-cost", "10000000"])
+    assert exit_info.value.code == 0
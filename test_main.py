@@ -18,7 +18,28 @@
 #
 import pytest
 
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import ctxcache
+import landmark
 from _contextual import main
+from ctxresolve import Resolver
+
+# seconds a warm resolution may add to bare (-IS) interpreter startup
+RESOLVE_BUDGET = 0.015
+# modules only needed for parsing or globbing
+LAZY_MODULES = {"fnmatch", "functools", "glob", "hashlib", "pickle", "re", "shlex"}
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(monkeypatch, tmpdir):
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
 
 
 @pytest.fixture(scope="function")
@@ -176,6 +197,7 @@ def test_trace(home_and_projs, monkeypatch, capsys):
     assert out == "exit 0\n"
     trace_lines = err.splitlines()
     assert trace_lines == [
+        u"resolution-cache: miss (no entries)",
         u"start-dir[PWD]: {}".format(a.strpath),
         u" ~~ {} := PROJ=1 => {!r}".format(p1.strpath, [p1.strpath]),
         u" ~~ {} := PROJ=2 => no".format(p2.strpath),
@@ -184,3 +206,689 @@ def test_trace(home_and_projs, monkeypatch, capsys):
         u" ~~ {} := PROJ=2 => no".format(p2.strpath),
         u"CONTEXT => PROJ=1",
     ]
+
+
+def test_shortcut(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    home.join("proj1", ".git").ensure_dir()
+    conf = u"""
+{0}/* where -d .git := GIT={{ctx_dir}}
+{0}/* := export PROJ={{ctx_dir}}
+{0}/proj2 := PROJ2=1
+""".format(
+        home.strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    monkeypatch.chdir(b.strpath)
+    monkeypatch.setenv("PWD", b.strpath)
+    main([confp.strpath, "@proj1", "cmd"])
+    out, err = capsys.readouterr()
+    p1 = a.dirpath().strpath
+    assert out == "export PROJ={0};GIT={0}\n".format(p1)
+
+    with pytest.raises(SystemExit) as exit_info:
+        main([confp.strpath, "@proj2", "cmd", ":trace"])
+    assert exit_info.value.code == 0
+    out, err = capsys.readouterr()
+    assert err.splitlines() == [
+        "shortcut: @proj2",
+        " ~~ {}/* where -d .git := GIT={{ctx_dir}} => no".format(home.strpath),
+        " ~~ {0}/* := export PROJ={{ctx_dir}} => {1!r}".format(
+            home.strpath, [b.dirpath().strpath]
+        ),
+        " ~~ {}/proj2 := PROJ2=1 => {!r}".format(home.strpath, [b.dirpath().strpath]),
+        "CONTEXT => PROJ2=1;export PROJ={}".format(b.dirpath().strpath),
+    ]
+
+    with pytest.raises(SystemExit) as exit_info:
+        main([confp.strpath, "@proj3", "cmd"])
+    assert exit_info.value.code == 1
+    out, err = capsys.readouterr()
+    assert err == "contextual: failed to infer context: @proj3\n"
+    # new projects are picked up
+    home.join("proj3").ensure_dir()
+    main([confp.strpath, "@proj3", "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "export PROJ={}\n".format(home.join("proj3").strpath)
+
+
+def test_shortcut_included(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    inc = u"""
+{0}/proj1 := P1=1
+{0}/* := export PROJ={{ctx_dir}}
+/opt := OUT=1
+""".format(
+        home
+    )
+    home.join("inc.conf").write_text(inc, encoding="ascii")
+    confp = home.join("ctx.conf")
+    conf = u"include {0} inc.conf\n{0}/proj2 := P2=1\n".format(home)
+    confp.write_text(conf, encoding="ascii")
+    monkeypatch.chdir(b.strpath)
+    monkeypatch.setenv("PWD", b.strpath)
+    main([confp.strpath, "@proj1", "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "export PROJ={};P1=1\n".format(a.dirpath())
+    main([confp.strpath, "@proj2", "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "P2=1;export PROJ={}\n".format(b.dirpath())
+    with pytest.raises(SystemExit):
+        main([confp.strpath, "@opt", "cmd"])
+    capsys.readouterr()
+    # changes of included files are picked up
+    home.join("inc.conf").write_text(u"{}/proj1 := P1=2\n".format(home), "ascii")
+    os.utime(home.join("inc.conf").strpath, ns=(1, 1))
+    main([confp.strpath, "@proj1", "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "P1=2\n"
+
+
+def test_include(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    p1 = a.dirpath()
+    conf = u"""
+{0}/* := export PROJ={{ctx_dir}}
+include {1} proj1.conf
+include {2} missing.conf
+/ := TOP=1
+""".format(
+        home.strpath, p1.strpath, b.dirpath().strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    included = home.join("proj1.conf")
+    included.write("{} := P1=1\n".format(p1.strpath))
+    monkeypatch.chdir(a.strpath)
+    monkeypatch.setenv("PWD", a.strpath)
+    main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "TOP=1;P1=1;export PROJ={}\n".format(p1.strpath)
+    # the file for proj2 is never opened
+    assert err == ""
+
+    included.write("{} := P1=2\n".format(p1.strpath))
+    os.utime(included.strpath, ns=(1, 1))
+    main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "TOP=1;P1=2;export PROJ={}\n".format(p1.strpath)
+
+
+@pytest.mark.skipif(not os.path.exists("/bin/bash"), reason="needs bash")
+def test_capture(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    runs = home.join("runs")
+    script = home.join("proj1", "activate")
+    script.write(
+        "echo run >> {}\n"
+        "export PATH=/venv/bin:$PATH CTX_DIR=$PWD\n"
+        "unset CAPTURE_GONE\n".format(runs.strpath)
+    )
+    conf = u"""
+{0}/* capture where -f activate := source {{1}}
+{0}/* := export PROJ={{ctx_dir}}
+""".format(
+        home.strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    monkeypatch.setenv("CAPTURE_GONE", "1")
+    monkeypatch.chdir(a.strpath)
+    monkeypatch.setenv("PWD", a.strpath)
+    main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    p1 = a.dirpath().strpath
+    assert out == (
+        "export PROJ={0};unset CAPTURE_GONE;export CTX_DIR={0};"
+        'export PATH=/venv/bin:"$PATH"\n'.format(p1)
+    )
+    assert runs.read() == "run\n"
+
+    # replayed for other start directories without running the script
+    p2p1.join("c").ensure_dir()
+    monkeypatch.chdir(p2p1.join("c").strpath)
+    monkeypatch.setenv("PWD", a.strpath)
+    main([confp.strpath, "cmd"])
+    out2, err = capsys.readouterr()
+    assert out2 == out
+    assert runs.read() == "run\n"
+
+    # captured again when the script changes
+    script.write("echo run >> {}\nexport CHANGED=1\n".format(runs.strpath))
+    os.utime(script.strpath, ns=(1, 1))
+    main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "export PROJ={0};export CHANGED=1\n".format(p1)
+    assert runs.read() == "run\nrun\n"
+
+
+def test_resolver(home_and_projs, capsys):
+    home, a, b, p2p1 = home_and_projs
+    p1 = a.dirpath()
+    venv = p1.join("venv", "bin", "activate").ensure()
+    conf = u"""
+{0}/** where -f */bin/activate := source {{1}}
+{0}/* := export PROJ={{ctx_dir}}
+/ :=
+""".format(
+        home.strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    resolver = Resolver(confp.strpath)
+    res = resolver.resolve([a.strpath, ("getcwd", p2p1.strpath)])
+    assert res.context == "export PROJ={0};source {1}".format(p1.strpath, venv)
+    assert res.as_dict()["matches"] == [
+        {
+            "rule": "{}/** where -f */bin/activate := source {{1}}".format(home),
+            "start_dir": ["dir", a.strpath],
+            "ctx_dir": p1.strpath,
+            "placeholders": [p1.strpath, venv.strpath],
+            "context": "source {}".format(venv),
+        },
+        {
+            "rule": "{}/* := export PROJ={{ctx_dir}}".format(home),
+            "start_dir": ["dir", a.strpath],
+            "ctx_dir": p1.strpath,
+            "placeholders": [p1.strpath],
+            "context": "export PROJ={}".format(p1),
+        },
+        {
+            "rule": "/ :=",
+            "start_dir": ["dir", a.strpath],
+            "ctx_dir": "/",
+            "placeholders": ["/"],
+            "context": None,
+        },
+    ]
+    # probes are kept until invalidated
+    venv.remove()
+    assert resolver.resolve([a.strpath]).context == res.context
+    resolver.invalidate()
+    res = resolver.resolve([a.strpath])
+    assert res.context == "export PROJ={}".format(p1)
+    assert len(res.matches) == 2
+
+    assert resolver.resolve(["/tmp"]).matches[0].rule == "/ :="
+    confp.write_text(conf.replace("/ :=", ""), encoding="ascii")
+    os.utime(confp.strpath, ns=(1, 1))
+    resolver.invalidate(rules=True)
+    res = resolver.resolve(["/tmp"])
+    assert res.matches == []
+    assert res.context is None
+    out, err = capsys.readouterr()
+    assert out == err == ""
+
+
+def test_threads(home_and_projs, monkeypatch, tmpdir, capsys):
+    home, a, b, p2p1 = home_and_projs
+    a.dirpath().join("venv", "bin", "activate").ensure()
+    conf = u"""
+{0}/** where -f */bin/activate := source {{1}}
+{0}/* := export PROJ={{ctx_dir}}
+{1} := PROJ=2
+""".format(
+        home.strpath, b.dirpath().strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    outs = []
+    for threads in ["", "8"]:
+        # resolve afresh
+        monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache" + threads).strpath)
+        environ = {"PWD": p2p1.join("a").strpath, "CONTEXTUAL_THREADS": threads}
+        main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+        outs.append(capsys.readouterr())
+    assert outs[0] == outs[1]
+    assert "source " in outs[0][0]
+
+
+def test_deadline(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+    stalled = threading.Event()
+    checked = []
+
+    @landmark.register_check("-stalled")
+    def check_stalled(q):
+        checked.append(q)
+        stalled.wait(5)
+        return True
+
+    conf = u"""
+{} where -stalled {{0}} := STALLED=1
+{} := PROJ=1
+""".format(
+        home.strpath, a.dirpath().strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    environ = {
+        "PWD": a.strpath,
+        "CONTEXTUAL_DEADLINE": "0.1",
+        "CONTEXTUAL_SLOW_COOLDOWN": "60",
+    }
+    stalled_rule = "{} where -stalled {{0}} := STALLED=1".format(home.strpath)
+    try:
+        start = time.monotonic()
+        main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+        assert time.monotonic() - start < 1
+        out, err = capsys.readouterr()
+        assert out == "PROJ=1\n"
+        assert err == "contextual: [rule: {}] abandoned, exceeded deadline\n".format(
+            stalled_rule
+        )
+        assert ctxcache.slow_rules(confp.strpath) == {stalled_rule}
+        # in cool-down the rule is not tried
+        del checked[:]
+        main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+        out, err = capsys.readouterr()
+        assert out == "PROJ=1\n"
+        assert "skipped, exceeded deadline recently" in err
+        assert checked == []
+    finally:
+        stalled.set()
+
+
+
+
+
+def test_resolver_retries_abandoned(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+    stalled = threading.Event()
+    stalls = [True]
+
+    @landmark.register_check("-flaky")
+    def check_flaky(q):
+        if stalls:
+            stalled.wait(5)
+        return True
+
+    confp = home.join("ctx.conf")
+    rule = "{}/** within 0.1 where -flaky {{0}} := M=1".format(home)
+    confp.write_text(rule + "\n", encoding="ascii")
+    resolver = Resolver(confp.strpath)
+    try:
+        assert resolver.resolve([a.strpath]).context is None
+    finally:
+        stalled.set()
+    assert "abandoned, exceeded deadline" in capsys.readouterr()[1]
+    del stalls[:]
+    assert resolver.resolve([a.strpath]).context == "M=1"
+
+
+def test_deadline_included(home_and_projs, monkeypatch, tmpdir, capsys):
+    home, a, b, p2p1 = home_and_projs
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    monkeypatch.setattr(landmark, "LANDMARK_CHECKS", dict(landmark.LANDMARK_CHECKS))
+    stalled = threading.Event()
+
+    @landmark.register_check("-stalled")
+    def check_stalled(q):
+        stalled.wait(5)
+        return True
+
+    stalled_rule = "{}/** within 0.1 where -stalled {{0}} := STALLED=1".format(home)
+    home.join("inc.conf").write_text(stalled_rule + "\n", encoding="ascii")
+    conf = u"include {} inc.conf\n{} := PROJ=1\n".format(home, a.dirpath())
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    try:
+        start = time.monotonic()
+        main([confp.strpath, "cmd"], environ={"PWD": a.strpath}, cwd=a.strpath)
+        assert time.monotonic() - start < 1
+    finally:
+        stalled.set()
+    out, err = capsys.readouterr()
+    assert out == "PROJ=1\n"
+    # given up on once, not again for the next start dir
+    assert err == "contextual: [rule: {}] abandoned, exceeded deadline\n".format(
+        stalled_rule
+    )
+
+
+def test_deadline_skipped_not_stored(home_and_projs, monkeypatch, tmpdir, capsys):
+    home, a, b, p2p1 = home_and_projs
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    conf = u"""
+{} where -d {{0}} := SLOW=1
+{} := PROJ=1
+""".format(
+        home.strpath, a.dirpath().strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    slow_rule = "{} where -d {{0}} := SLOW=1".format(home.strpath)
+    ctxcache.mark_slow_rules(confp.strpath, [slow_rule], 60)
+    environ = {"PWD": a.strpath, "CONTEXTUAL_SLOW_COOLDOWN": "60"}
+    main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+    out, err = capsys.readouterr()
+    assert out == "PROJ=1\n"
+    assert "skipped, exceeded deadline recently" in err
+    # the partial result was not stored, out of cool-down it resolves in full
+    main([confp.strpath, "cmd"], environ={"PWD": a.strpath}, cwd=a.strpath)
+    out, err = capsys.readouterr()
+    assert out == "PROJ=1;SLOW=1\n"
+
+
+def test_profile(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    p1 = a.dirpath()
+    p2 = b.dirpath()
+    p1.join("venv", "bin", "activate").ensure()
+    conf = u"""
+{}/** where -f */bin/activate := source {{1}}
+{} := PROJ=2
+/  :=
+""".format(
+        home.strpath, p2.strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    monkeypatch.chdir(a.strpath)
+    monkeypatch.setenv("PWD", a.strpath)
+    with pytest.raises(SystemExit) as exit_info:
+        main([confp.strpath, "cmd", ":profile"])
+    assert exit_info.value.code == 0
+    out, err = capsys.readouterr()
+    assert out == "exit 0\n"
+    report = json.loads(err)
+    assert report["rules"] == 3
+    assert report["total_s"] >= report["parse_s"] + report["match_s"]
+    per_rule = [
+        (r["rule"], r["start_dir"], r["matched"], r["dirs"], r["globs"], r["checks"])
+        for r in report["per_rule"]
+    ]
+    # rule 2 is not under a, matched rules are not tried again
+    assert per_rule == [
+        (
+            u"{}/** where -f */bin/activate := source {{1}}".format(home.strpath),
+            "PWD",
+            True,
+            2,
+            2,
+            1,
+        ),
+        (u"/  :=", "PWD", True, 1, 0, 0),
+    ]
+    venv_rule = report["per_rule"][0]
+    assert venv_rule["depth"] == 1
+    assert venv_rule["fs_calls"]["scandir"] > 0
+    assert report["steps"]["dirs"] == 3
+    assert report["fs_calls"] == {
+        call: sum(r["fs_calls"][call] for r in report["per_rule"])
+        for call in report["fs_calls"]
+    }
+
+
+def test_cache_command(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    confp = home.join("ctx.conf")
+    confp.write_text(u"/ := PROJ=0\n", encoding="ascii")
+    with pytest.raises(SystemExit) as exit_info:
+        main([confp.strpath, ":cache"])
+    assert exit_info.value.code == 0
+    out, err = capsys.readouterr()
+    assert out == "exit 0\n"
+    assert "state: missing" in err.splitlines()
+
+    with pytest.raises(SystemExit) as exit_info:
+        main([confp.strpath, ":cache", "rebuild"])
+    assert exit_info.value.code == 0
+    out, err = capsys.readouterr()
+    assert out == "exit 0\n"
+    info = err.splitlines()
+    assert "state: fresh" in info
+    assert "rules: 1" in info
+    assert "contexts: 0" in info
+
+
+def test_resolution_cache(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    conf = u"""
+{}/** where -d .git := PROJ={{ctx_dir}}
+/ :=
+""".format(
+        home.strpath
+    )
+    confp = home.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    monkeypatch.chdir(a.strpath)
+    monkeypatch.setenv("PWD", a.strpath)
+    main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "\n"
+
+    with pytest.raises(SystemExit):
+        main([confp.strpath, "cmd", ":trace"])
+    out, err = capsys.readouterr()
+    assert err.splitlines()[0] == "resolution-cache: hit"
+
+    def no_match(*args):
+        raise AssertionError("rules should not be evaluated")
+
+    with monkeypatch.context() as m:
+        m.setattr("landmark.Landmark.match", no_match)
+        main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "\n"
+
+    git = a.dirpath().join(".git").ensure_dir()
+    with pytest.raises(SystemExit):
+        main([confp.strpath, "cmd", ":trace"])
+    out, err = capsys.readouterr()
+    assert err.splitlines()[0] == (
+        "resolution-cache: invalidated (stat {} changed)".format(git.strpath)
+    )
+    main([confp.strpath, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "PROJ={}\n".format(a.dirpath().strpath)
+
+
+def test_hook_resolve(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    confp = home.join("ctx.conf")
+    confp.write_text(u"{} := PROJ=1\n".format(a.strpath), encoding="ascii")
+    monkeypatch.chdir(a.strpath)
+    stamps = ctxcache.stamps_dir(confp.strpath)
+    stamp = os.path.join(stamps, str(os.getpid()))
+    environ = {"PWD": a.strpath, "_CONTEXTUAL_STAMP": stamp}
+    main([confp.strpath, ":hook", "resolve"], environ=environ)
+    out, err = capsys.readouterr()
+    assert out == "PROJ=1\n"
+    assert os.stat(stamp).st_mtime_ns == os.stat(confp.strpath).st_mtime_ns
+
+    # stamps of shells no longer running are pruned
+    dead = os.path.join(stamps, "999999999")
+    open(dead, "w").close()
+    for shell in ["bash", "zsh"]:
+        with pytest.raises(SystemExit) as exit_info:
+            main([confp.strpath, ":hook", shell])
+        assert exit_info.value.code == 0
+        out, err = capsys.readouterr()
+        assert "_contextual_hook()" in out
+        assert "export _CONTEXTUAL_CFG={} _CONTEXTUAL_STAMP={}/$$\n".format(
+            confp.strpath, stamps
+        ) in out
+    assert os.listdir(stamps) == [str(os.getpid())]
+
+
+def test_shell_entry_on_hit(home_and_projs, monkeypatch, capsys):
+    home, a, b, p2p1 = home_and_projs
+    confp = home.join("ctx.conf")
+    confp.write_text(u"{} := PROJ=1\n".format(a.strpath), encoding="ascii")
+    entry_p = ctxcache.shell_entry_path(confp.strpath, a.strpath)
+    environ = {"PWD": a.strpath}
+    main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+    entry = os.stat(entry_p)
+    # a usable entry is left alone by hits
+    main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+    assert os.stat(entry_p).st_ino == entry.st_ino
+    # a missing one is stored again
+    os.unlink(entry_p)
+    main([confp.strpath, "cmd"], environ=environ, cwd=a.strpath)
+    assert os.path.exists(entry_p)
+    out, err = capsys.readouterr()
+    assert out == "PROJ=1\n" * 3
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_hook_trampoline(home_and_projs, tmpdir):
+    home, a, b, p2p1 = home_and_projs
+    landmark = a.join(".proj").ensure()
+    confp = home.join("ctx.conf")
+    conf = u"{}/** where -e .proj := echo CTX={{ctx_dir}}\n/ :=\n".format(home)
+    confp.write_text(conf, encoding="ascii")
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(
+        os.environ,
+        PATH="{}:{}".format(here, os.environ["PATH"]),
+        XDG_CACHE_HOME=tmpdir.join("cache").strpath,
+        CONTEXTUAL_SOCKET=tmpdir.join("none.sock").strpath,
+    )
+    script = """
+eval "$(_contextual.py {conf} :hook bash)"
+cd {a}
+_contextual_hook
+contextual {conf} true
+rm {landmark}
+# context is reused without running _contextual.py
+contextual {conf} true
+cd {b}
+_contextual_hook
+contextual {conf} true
+# commands of contextual itself are not run with the context
+contextual {conf} :cache 2>&1 | head -1
+""".format(
+        conf=confp.strpath, a=a.strpath, b=b.strpath, landmark=landmark.strpath
+    )
+    res = subprocess.run(
+        ["bash", "-c", script], env=env, stdout=subprocess.PIPE, check=True
+    )
+    ctx = "CTX={}".format(a.strpath)
+    lines = res.stdout.decode("ascii").splitlines()
+    assert lines[:2] == [ctx, ctx]
+    assert lines[2].startswith("config: ")
+
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_hook_stamp_per_shell(home_and_projs, tmpdir):
+    home, a, b, p2p1 = home_and_projs
+    confp = home.join("ctx.conf")
+    confp.write_text(u"{} := echo V=1\n".format(a.strpath), encoding="ascii")
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(
+        os.environ,
+        PATH="{}:{}".format(here, os.environ["PATH"]),
+        XDG_CACHE_HOME=tmpdir.join("cache").strpath,
+        CONTEXTUAL_SOCKET=tmpdir.join("none.sock").strpath,
+    )
+    other = 'eval "$(_contextual.py {conf} :hook bash)"; cd {a}; _contextual_hook'
+    script = """
+eval "$(_contextual.py {conf} :hook bash)"
+cd {a}
+_contextual_hook
+contextual {conf} true
+echo "{a} := echo V=2" > {conf}
+touch -d '+2 seconds' {conf}
+# another shell resolving with the edited config
+bash -c '{other}'
+contextual {conf} true
+""".format(
+        conf=confp.strpath, a=a.strpath, other=other.format(conf=confp.strpath, a=a)
+    )
+    res = subprocess.run(
+        ["bash", "-c", script], env=env, stdout=subprocess.PIPE, check=True
+    )
+    assert res.stdout.decode("ascii").splitlines() == ["V=1", "V=2"]
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_shell_cache_trampoline(home_and_projs, tmpdir):
+    home, a, b, p2p1 = home_and_projs
+    landmark = a.join(".proj").ensure()
+    confp = home.join("ctx.conf")
+    conf = u"{}/** where -e .proj := echo CTX={{ctx_dir}}\n/ :=\n".format(home)
+    confp.write_text(conf, encoding="ascii")
+    here = os.path.dirname(os.path.abspath(__file__))
+    bin_d = tmpdir.join("bin").ensure_dir()
+    runs = tmpdir.join("runs")
+    wrapper = bin_d.join("_contextual.py")
+    wrapper.write(
+        "#!/bin/bash\necho run >> {}\nexec {} \"$@\"\n".format(
+            runs.strpath, os.path.join(here, "_contextual.py")
+        )
+    )
+    wrapper.chmod(0o755)
+    env = dict(
+        os.environ,
+        PATH="{}:{}:{}".format(bin_d, here, os.environ["PATH"]),
+        XDG_CACHE_HOME=tmpdir.join("cache").strpath,
+        CONTEXTUAL_SOCKET=tmpdir.join("none.sock").strpath,
+    )
+    script = """
+cd {a}
+contextual {conf} true
+# served from the entry stored by the first run
+contextual {conf} true
+rm {landmark}
+contextual {conf} true
+touch {landmark}
+contextual {conf} true
+contextual {conf} true
+""".format(
+        conf=confp.strpath, a=a.strpath, landmark=landmark.strpath
+    )
+    res = subprocess.run(
+        ["bash", "-c", script], env=env, stdout=subprocess.PIPE, check=True
+    )
+    ctx = "CTX={}".format(a.strpath)
+    assert res.stdout.decode("ascii").splitlines() == [ctx, ctx, ctx, ctx]
+    assert runs.read() == "run\n" * 3
+
+
+@pytest.fixture(scope="function")
+def fast_start(home_and_projs, tmpdir):
+    """=> argv running _contextual.py -IS, its env, with warm caches"""
+    home, a, b, p2p1 = home_and_projs
+    confp = home.join("ctx.conf")
+    conf = u"{}/* where -d .git -f */bin/activate := source {{2}}\n/ :=\n"
+    confp.write_text(conf.format(home), encoding="ascii")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_contextual.py")
+    env = dict(os.environ, PWD=a.strpath, XDG_CACHE_HOME=tmpdir.join("c").strpath)
+    argv = [sys.executable, "-IS", script, confp.strpath, "cmd"]
+    subprocess.run(argv, cwd=a.strpath, env=env, stdout=subprocess.DEVNULL, check=True)
+    return argv, env, a.strpath
+
+
+def test_fast_start_imports(fast_start):
+    argv, env, cwd = fast_start
+    argv = argv[:2] + ["-X", "importtime"] + argv[2:]
+    res = subprocess.run(argv, cwd=cwd, env=env, stderr=subprocess.PIPE, check=True)
+    imported = set(
+        line.rsplit("|", 1)[1].strip()
+        for line in res.stderr.decode("ascii").splitlines()
+        if line.startswith("import time:")
+    )
+    assert "landmark" in imported
+    assert not imported & LAZY_MODULES
+
+
+def test_fast_start_budget(fast_start):
+    argv, env, cwd = fast_start
+
+    def best_time(argv):
+        best = None
+        for i in range(5):
+            start = time.perf_counter()
+            subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    bare = best_time([sys.executable, "-IS", "-c", "pass"])
+    resolve = best_time(argv)
+    assert resolve - bare < RESOLVE_BUDGET
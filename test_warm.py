@@ -0,0 +1,93 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import os
+
+import _contextual_warm
+import ctxcache
+from _contextual import main
+
+
+@pytest.fixture(scope="function")
+def tree(request, monkeypatch, tmpdir):
+    """=> config, project dirs p1, p2, p3"""
+    request.addfinalizer(lambda: tmpdir.remove(rec=1, ignore_errors=True))
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    root = tmpdir.join("root")
+    dirs = [root.join(name).ensure_dir().strpath for name in ("p1", "p2", "p3")]
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(u"{}/* := export PROJ={{ctx_dir}}\n".format(root), "ascii")
+    return confp.strpath, dirs
+
+
+def run_from(conf, d, capsys):
+    main([conf, "cmd"], environ={"PWD": d}, cwd=d)
+    return capsys.readouterr()[0]
+
+
+def test_history(tree, capsys, monkeypatch):
+    conf, dirs = tree
+    monkeypatch.setattr(ctxcache, "MAX_HISTORY", 2)
+    assert ctxcache.load_history(conf) == []
+    for d in dirs:
+        run_from(conf, d, capsys)
+    run_from(conf, dirs[1], capsys)
+    run_from(conf, dirs[1], capsys)
+    assert ctxcache.load_history(conf) == [
+        _contextual_warm.dir_locations(dirs[1]),
+        _contextual_warm.dir_locations(dirs[2]),
+    ]
+    # trace runs and commands with a directory part are not recorded
+    with pytest.raises(SystemExit):
+        main([conf, "cmd", ":trace"], environ={"PWD": dirs[0]}, cwd=dirs[0])
+    main([conf, "./cmd"], environ={"PWD": dirs[0]}, cwd=dirs[0])
+    assert len(ctxcache.load_history(conf)) == 2
+    assert ctxcache.load_history(conf)[0][0] == ("PWD", dirs[1])
+
+
+def test_warm_history(tree, capsys):
+    conf, dirs = tree
+    for d in dirs[:2]:
+        run_from(conf, d, capsys)
+    # a config edit invalidates the cached contexts
+    with open(conf, "a") as f:
+        f.write("/ := ROOT=1\n")
+    locations = _contextual_warm.dir_locations(dirs[0])
+    assert ctxcache.lookup_context(conf, locations)[1] == "config changed"
+    _contextual_warm.main([conf, "--nice", "0"], environ={})
+    for d in dirs[:2]:
+        locations = _contextual_warm.dir_locations(d)
+        status, detail, context = ctxcache.lookup_context(conf, locations)
+        assert (status, context) == ("hit", "ROOT=1;export PROJ={}".format(d))
+        assert os.path.exists(ctxcache.shell_entry_path(conf, d))
+    locations = _contextual_warm.dir_locations(dirs[2])
+    assert ctxcache.lookup_context(conf, locations)[0] == "miss"
+
+
+def test_warm_dirs_file(tree, tmpdir):
+    conf, dirs = tree
+    dirs_file = tmpdir.join("dirs")
+    dirs_file.write("\n".join(dirs + [tmpdir.join("gone").strpath]) + "\n")
+    _contextual_warm.main([conf, "--nice", "0", dirs_file.strpath], environ={})
+    for d in dirs:
+        locations = _contextual_warm.dir_locations(d)
+        assert ctxcache.lookup_context(conf, locations)[0] == "hit"
+    # not recorded in the history
+    assert ctxcache.load_history(conf) == []
@@ -0,0 +1,147 @@
+# contextual: providing context for shell command invocations
+# Copyright 2008-2015  Samuele Pedroni
+#
+# This file is part of contextual.
+#
+# contextual is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# contextual is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with contextual.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+import errno
+import sys
+
+from _contextual import main
+from _contextual_watch import ContextWatcher
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+
+
+@pytest.fixture(scope="function")
+def watcher(request, monkeypatch, tmpdir):
+    """=> watcher of root with p1/sub, p2"""
+    request.addfinalizer(lambda: tmpdir.remove(rec=1, ignore_errors=True))
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("cache").strpath)
+    root = tmpdir.join("root")
+    root.join("p1", "sub").ensure_dir()
+    root.join("p2").ensure_dir()
+    conf = u"""
+{}/* where -f venv/bin/activate := source {{1}}
+/ :=
+""".format(
+        root.strpath
+    )
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(conf, encoding="ascii")
+    watcher = ContextWatcher(confp.strpath, root.strpath)
+    watcher.build()
+    request.addfinalizer(watcher.inotify.close)
+    return watcher
+
+
+def settle(watcher):
+    events = watcher.inotify.read_events(0.1)
+    while events:
+        watcher.handle_events(events)
+        events = watcher.inotify.read_events(0.1)
+
+
+def test_build(watcher):
+    root = watcher.root
+    assert watcher.contexts == {
+        root: "",
+        root + "/p1": "",
+        root + "/p1/sub": "",
+        root + "/p2": "",
+    }
+
+
+def test_landmark_appears_and_disappears(watcher, tmpdir):
+    root = tmpdir.join("root")
+    activate = root.join("p1", "venv", "bin", "activate")
+    activate.write_text(u"#", "ascii", ensure=True)
+    settle(watcher)
+    ctx = "source {}".format(activate.strpath)
+    assert watcher.contexts[root.join("p1").strpath] == ctx
+    assert watcher.contexts[root.join("p1", "sub").strpath] == ctx
+    assert watcher.contexts[root.join("p1", "venv", "bin").strpath] == ctx
+    assert watcher.contexts[root.join("p2").strpath] == ""
+
+    assert watcher.affected(activate.strpath) == set(
+        p for p in watcher.contexts if p.startswith(root.join("p1").strpath)
+    )
+    assert root.join("p2").strpath not in watcher.affected(activate.strpath)
+
+    root.join("p1", "venv").remove(rec=1)
+    settle(watcher)
+    assert watcher.contexts[root.join("p1", "sub").strpath] == ""
+    assert root.join("p1", "venv").strpath not in watcher.contexts
+
+
+def test_lookup_from_main(watcher, tmpdir, monkeypatch, capsys):
+    root = tmpdir.join("root")
+    activate = root.join("p2", "venv", "bin", "activate")
+    activate.write_text(u"#", "ascii", ensure=True)
+    settle(watcher)
+    sub = root.join("p2", "venv")
+    monkeypatch.chdir(sub.strpath)
+    monkeypatch.setenv("PWD", sub.strpath)
+
+    def no_match(*args):
+        raise AssertionError("rules should not be evaluated")
+
+    with monkeypatch.context() as m:
+        m.setattr("landmark.Landmark.match", no_match)
+        main([watcher.cfg_path, "cmd"])
+    out, err = capsys.readouterr()
+    assert out == "source {}\n".format(activate.strpath)
+
+    with pytest.raises(SystemExit):
+        main([watcher.cfg_path, "cmd", ":trace"])
+    out, err = capsys.readouterr()
+    assert err.splitlines()[0] == "watch-map: hit"
+
+    monkeypatch.chdir(tmpdir.strpath)
+    monkeypatch.setenv("PWD", tmpdir.strpath)
+    with pytest.raises(SystemExit):
+        main([watcher.cfg_path, "cmd", ":trace"])
+    out, err = capsys.readouterr()
+    assert err.splitlines()[0] == "watch-map: not covered"
+
+
+def test_config_change(watcher, tmpdir):
+    confp = tmpdir.join("ctx.conf")
+    confp.write_text(u"/ := X\n", encoding="ascii")
+    settle(watcher)
+    assert set(watcher.contexts.values()) == {"X"}
+
+
+def test_watch_failure(watcher, tmpdir, monkeypatch):
+    root = tmpdir.join("root")
+    new = root.join("p3").strpath
+    real_add_watch = watcher.inotify.add_watch
+
+    def add_watch(path, *args):
+        if path.startswith(new):
+            raise OSError(errno.ENOSPC, "out of watches", path)
+        return real_add_watch(path, *args)
+
+    monkeypatch.setattr(watcher.inotify, "add_watch", add_watch)
+    root.join("p3", "sub").ensure_dir()
+    settle(watcher)
+    # changes under them would be missed, left to normal resolution
+    assert new not in watcher.contexts
+    assert new + "/sub" not in watcher.contexts
+    assert root.join("p2").strpath in watcher.contexts